@@ -4,6 +4,7 @@ import hashlib
 import sys
 from common import make_connection
 from cursor_wrapper import CursorWrapper
+from row_stream import stream_rows
 from volume_holder import VolumeHolder
 
 class Extender(VolumeHolder, CursorWrapper):
@@ -17,10 +18,11 @@ class Extender(VolumeHolder, CursorWrapper):
         volume_id = self.get_volume_id(url_id)
         content_type = self.get_content_type(url_id, volume_id)
 
-        f = self.open_page(url_id, volume_id)
+        body_volume_id, body_hash = self.get_body_location(url_id)
+        f = self.open_page(url_id, body_volume_id, body_hash)
         if f is not None:
             try:
-                sz = self.get_body_size(url_id, volume_id)
+                sz = self.get_body_size(url_id, body_volume_id, body_hash)
                 self.hash_content(url_id, content_type, f, sz)
             finally:
                 f.close()
@@ -64,13 +66,11 @@ def main():
         with conn.cursor() as cur:
             extender = Extender(cur)
             try:
-                cur.execute("""select url, id
+                for row in stream_rows("""select url, id
 from field
 left join extra on field.id=extra.url_id
 where checkd is not null and has_body is null
-order by url""")
-                rows = cur.fetchall()
-                for row in rows:
+order by url"""):
                     extender.extend(*row)
             finally:
                 extender.close()
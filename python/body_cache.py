@@ -0,0 +1,32 @@
+import hashlib
+import io
+from common import get_option
+from freq_cache import FreqCache
+from page_parser import HrefRecorder
+
+class BodyCache:
+    # Links found in recently parsed bodies, keyed by SHA-1 of the
+    # body (as in extra.hash). Events are recorded unresolved, so they
+    # can be replayed for the same body under a different URL.
+    def __init__(self, size):
+        self.cache = FreqCache(size)
+
+    def get_events(self, fp, body_hash=None):
+        if body_hash is None:
+            # unknown hash - the whole body is read to compute it
+            body = fp.read()
+            body_hash = hashlib.sha1(body).hexdigest()
+            fp = io.BytesIO(body)
+
+        events = self.cache.get(body_hash)
+        if events is None:
+            recorder = HrefRecorder()
+            recorder.parse_links(fp)
+            events = recorder.events
+            self.cache.put(body_hash, events)
+
+        return events
+
+def make_body_cache():
+    size = int(get_option('body_cache_size', "0"))
+    return BodyCache(size) if size > 0 else None
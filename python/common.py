@@ -20,7 +20,7 @@ def get_mandatory_option(name):
 
 schema = get_option("schema", "")
 
-def get_volume_path(volume_id):
+def get_data_dir():
     data_dir = os.path.join(get_parent_directory(), "data")
 
     if schema:
@@ -29,20 +29,52 @@ def get_volume_path(volume_id):
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
+    return data_dir
+
+def get_volume_path(volume_id):
     name = "%d.zip" % (volume_id,)
-    return os.path.join(data_dir, name)
+    return os.path.join(get_data_dir(), name)
 
-def get_loose_path(url_id, hdr=False, alt_repre=None):
+def get_filter_path(name):
+    return os.path.join(get_data_dir(), name + ".filter")
+
+def get_tmp_dir():
     tmp_dir = os.path.join(get_parent_directory(), "tmp")
 
     if schema:
         tmp_dir = os.path.join(tmp_dir, schema)
 
+    return tmp_dir
+
+def get_blob_path(body_hash):
+    # bodies shared by multiple URLs, see body_dedup
+    blob_dir = os.path.join(get_tmp_dir(), "blobs", body_hash[:2])
+    if not os.path.exists(blob_dir):
+        os.makedirs(blob_dir)
+
+    return os.path.join(blob_dir, body_hash)
+
+def get_blob_lock_key(body_hash):
+    # for pg_advisory_lock, held while a blob's file is linked or
+    # released
+    return int(body_hash[:15], 16)
+
+def get_blob_name(body_hash):
+    # member name in volumes
+    return 'b' + body_hash
+
+def get_loose_dir(url_id, alt_repre=None):
+    # doesn't create the directory - see get_loose_path
+    tmp_dir = get_tmp_dir()
+
     if alt_repre:
         tmp_dir = os.path.join(tmp_dir, alt_repre)
 
     middle = str(url_id % 1000)
-    loose_dir = os.path.join(tmp_dir, middle)
+    return os.path.join(tmp_dir, middle)
+
+def get_loose_path(url_id, hdr=False, alt_repre=None):
+    loose_dir = get_loose_dir(url_id, alt_repre)
     if not os.path.exists(loose_dir):
         os.makedirs(loose_dir)
 
@@ -1,10 +1,17 @@
 #!/usr/bin/python3
 
+import concurrent.futures
+import hashlib
+import multiprocessing
 import os
+import queue
+import signal
+import sys
 import time
-import zipfile
-from common import get_loose_path, get_option, get_volume_path, make_connection
+from common import get_blob_name, get_blob_path, get_data_dir, get_loose_dir, get_loose_path, get_option, get_volume_path, make_connection
 from host_check import get_instance_id
+from row_stream import stream_rows
+from volume_format import create_volume
 
 class Compressor:
     def __init__(self, cur):
@@ -15,6 +22,11 @@ class Compressor:
         self.zip_back = None
         self.volume_threshold = int(get_option('volume_threshold', str(1024 * 1024 * 1024)))
         self.compress_backoff = int(get_option('compress_backoff', str(3600)))
+        self.cleanup_threads = int(get_option('compress_cleanup_threads', "0"))
+        self.members = set() # URL IDs in the current volume
+        self.body_dedup = bool(get_option('body_dedup', False))
+        self.blobs = set() # body hashes stored in the current volume
+        self.refs = {} # url_id -> body hash, for bodies stored in the current volume or before
 
         inst_name = get_option("instance", None)
         self.inst_id = get_instance_id(cur, inst_name)
@@ -37,25 +49,31 @@ class Compressor:
             time.sleep(self.compress_backoff)
 
     def compress(self):
+        for url_id in self.get_loose_ids():
+            if url_id in self.members: # volume kept open from the previous round
+                continue
+
+            self.add_member(url_id)
+            if self.is_full():
+                self.close()
+
+    def get_loose_ids(self):
         if self.inst_id is None:
-            self.cur.execute("""select field.id
+            rows = stream_rows("""select field.id
 from field
 left join content on field.id=content.url_id
 where checkd is not null and volume_id is null
 order by url_id""")
         else:
-            self.cur.execute("""select field.id
+            rows = stream_rows("""select field.id
 from field
 join locality on field.id=locality.url_id
 left join content on field.id=content.url_id
 where checkd is not null and volume_id is null and instance_id=%s
 order by content.url_id""", (self.inst_id,))
 
-        rows = self.cur.fetchall()
         for row in rows:
-            self.add_member(row[0])
-            if self.is_full():
-                self.close()
+            yield row[0]
 
     def add_member(self, url_id):
         self.member_count += 1
@@ -65,19 +83,81 @@ order by content.url_id""", (self.inst_id,))
             print("packing volume %d..." % (self.volume_id,))
             archive_path = get_volume_path(self.volume_id)
             self.zip_back = open(archive_path, mode='wb')
-            self.zip_front = zipfile.ZipFile(self.zip_back, mode='w', compression=zipfile.ZIP_DEFLATED)
+            self.zip_front = create_volume(self.zip_back)
 
         self.add_member_half(url_id, True)
-        self.add_member_half(url_id, False)
+        if self.body_dedup:
+            self.add_body_blob(url_id)
+        else:
+            self.add_member_half(url_id, False)
 
-        self.cur.execute("""insert into content(url_id, volume_id)
-values(%s, %s)""", (url_id, self.volume_id))
+        self.members.add(url_id)
 
     def add_member_half(self, url_id, hdr):
         path = get_loose_path(url_id, hdr)
         if os.path.exists(path):
             self.zip_front.write(path, os.path.basename(path))
 
+    def add_body_blob(self, url_id):
+        loose_path = get_loose_path(url_id)
+        if os.path.exists(loose_path):
+            h = hashlib.sha1()
+            with open(loose_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+
+            body_hash = h.hexdigest()
+            self.refs[url_id] = body_hash
+            self.cond_add_blob(body_hash, loose_path)
+        else:
+            # maybe shared at download time
+            self.cur.execute("""select body_blob.hash
+from body_ref
+join body_blob on body_ref.hash=body_blob.hash
+where url_id=%s and volume_id is null""", (url_id,))
+            row = self.cur.fetchone()
+            if row:
+                blob_path = get_blob_path(row[0])
+                if os.path.exists(blob_path):
+                    self.cond_add_blob(row[0], blob_path)
+
+    def cond_add_blob(self, body_hash, path):
+        if body_hash in self.blobs:
+            return
+
+        self.cur.execute("""select volume_id
+from body_blob
+where hash=%s and volume_id is not null""", (body_hash,))
+        if self.cur.fetchone():
+            return
+
+        self.zip_front.write(path, get_blob_name(body_hash))
+        self.blobs.add(body_hash)
+
+    def finish_blobs(self):
+        # before the volume is marked as written, so that the pages are
+        # readable all the time
+        if self.blobs:
+            self.cur.execute("""insert into body_blob(hash, volume_id)
+select unnest(%s::char(40)[]), %s
+on conflict(hash) do update
+set volume_id=excluded.volume_id""", (sorted(self.blobs), self.volume_id))
+
+        if self.refs:
+            ref_ids = sorted(self.refs.keys())
+            self.cur.execute("""insert into body_ref(url_id, hash)
+select *
+from unnest(%s::integer[], %s::char(40)[])
+on conflict(url_id) do update
+set hash=excluded.hash""", (ref_ids, [ self.refs[url_id] for url_id in ref_ids ]))
+            print("%d pages share %d new bodies" % (len(self.refs), len(self.blobs)))
+
+        for body_hash in self.blobs:
+            self.cond_remove(get_blob_path(body_hash))
+
+        self.blobs = set()
+        self.refs = {}
+
     def add_volume(self):
         self.cur.execute("""insert into directory
 default values
@@ -95,27 +175,24 @@ values(%s, %s)""", (volume_id, self.inst_id))
         if self.volume_id is None:
             return
 
+        # the volume is complete, pages can be read from it
+        if self.members:
+            self.cur.execute("""insert into content(url_id, volume_id)
+select unnest(%s::integer[]), %s""", (sorted(self.members), self.volume_id))
+
+        if self.body_dedup:
+            self.finish_blobs()
+
         self.cur.execute("""update directory
 set written=localtimestamp
 where id=%s""", (self.volume_id,))
 
-        if self.inst_id:
+        if self.inst_id and self.members:
             self.cur.execute("""delete from locality
-where url_id in (
-        select url_id
-        from content
-        where volume_id=%s
-)""", (self.volume_id,))
-
-        self.cur.execute("""select url_id
-from content
-where volume_id=%s
-order by url_id""", (self.volume_id,))
-        rows = self.cur.fetchall()
-        for row in rows:
-            url_id = row[0]
-            self.cond_remove(get_loose_path(url_id))
-            self.cond_remove(get_loose_path(url_id, True))
+where url_id=any(%s)""", (sorted(self.members),))
+
+        remove_loose_files(self.members, self.cleanup_threads)
+        self.members = set()
 
         if self.member_count > 0:
             print("packed %d pages" % (self.member_count,))
@@ -137,11 +214,154 @@ order by url_id""", (self.volume_id,))
         self.finish_volume()
 
 
+def remove_shard_files(loose_dir, url_ids):
+    for url_id in url_ids:
+        for name in (str(url_id), str(url_id) + 'h'):
+            try:
+                os.remove(os.path.join(loose_dir, name))
+            except FileNotFoundError:
+                pass
+
+def remove_loose_files(url_ids, threads):
+    # removes packed pages' loose files, a directory at a time
+    shards = {} # loose dir -> [ url_id ]
+    for url_id in url_ids:
+        shards.setdefault(get_loose_dir(url_id), []).append(url_id)
+
+    if threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [ executor.submit(remove_shard_files, loose_dir, shard_ids) for loose_dir, shard_ids in shards.items() ]
+            for future in futures:
+                future.result()
+    else:
+        for loose_dir, shard_ids in shards.items():
+            remove_shard_files(loose_dir, shard_ids)
+
+def pack_volumes(task_queue, result_queue, volume_threshold):
+    # runs in a worker process, without DB access: packs URL IDs from
+    # task_queue into temporary volumes and reports each finished one
+    # as (path, URL IDs)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the coordinator stops us
+    seq = 0
+    path = None
+    zip_back = None
+    zip_front = None
+    members = []
+    while True:
+        url_id = task_queue.get()
+        if url_id is not None:
+            if zip_front is None:
+                seq += 1
+                path = os.path.join(get_data_dir(), "packing-%d-%d.zip" % (os.getpid(), seq))
+                zip_back = open(path, mode='wb')
+                zip_front = create_volume(zip_back)
+
+            for hdr in (True, False):
+                loose_path = get_loose_path(url_id, hdr)
+                if os.path.exists(loose_path):
+                    zip_front.write(loose_path, os.path.basename(loose_path))
+
+            members.append(url_id)
+
+        if (zip_front is not None) and ((url_id is None) or (os.fstat(zip_back.fileno()).st_size > volume_threshold)):
+            zip_front.close()
+            zip_front = None
+            zip_back.close()
+            zip_back = None
+            result_queue.put((path, members))
+            members = []
+
+        if url_id is None:
+            return
+
+class ParallelCompressor(Compressor):
+    # workers pack volumes, the coordinator (this object) allocates
+    # their IDs and does all the bookkeeping
+    def __init__(self, cur, workers):
+        Compressor.__init__(self, cur)
+        if self.body_dedup:
+            # workers pack bodies per page, without DB access
+            raise Exception("body_dedup not supported with --workers")
+
+        self.pending = set() # URL IDs sent to workers, not in a finished volume yet
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers = []
+        for i in range(workers):
+            worker = multiprocessing.Process(target=pack_volumes, args=(self.task_queue, self.result_queue, self.volume_threshold))
+            worker.start()
+            self.workers.append(worker)
+
+    def compress_all(self):
+        while True:
+            self.compress()
+            if not self.pending:
+                return
+
+            print("waiting %d seconds..." % (self.compress_backoff,))
+            self.collect(time.time() + self.compress_backoff)
+
+    def compress(self):
+        for url_id in self.get_loose_ids():
+            if url_id not in self.pending:
+                self.pending.add(url_id)
+                self.task_queue.put(url_id)
+
+    def collect(self, deadline):
+        while self.pending:
+            timeout = deadline - time.time() if deadline else 1
+            if deadline and (timeout <= 0):
+                return
+
+            try:
+                path, members = self.result_queue.get(timeout=min(timeout, 10))
+            except queue.Empty:
+                for worker in self.workers:
+                    if worker.exitcode:
+                        raise Exception("compress worker failed with exit code %d" % (worker.exitcode,))
+
+                if (not deadline) and not any(worker.is_alive() for worker in self.workers):
+                    print("%d pages not packed" % (len(self.pending),), file=sys.stderr)
+                    return
+
+                continue
+
+            self.finish_packed(path, members)
+
+    def finish_packed(self, path, members):
+        self.volume_id = self.add_volume()
+        print("packed volume %d..." % (self.volume_id,))
+        os.rename(path, get_volume_path(self.volume_id))
+        self.members = set(members)
+        self.member_count = len(members)
+        self.pending.difference_update(members)
+        self.finish_volume()
+
+    def close(self):
+        if not self.workers:
+            return
+
+        for worker in self.workers:
+            self.task_queue.put(None)
+
+        try:
+            self.collect(None)
+        finally:
+            for worker in self.workers:
+                worker.join()
+
+            self.workers = []
+
+
 def main():
+    workers = 0
+    if (len(sys.argv) == 3) and (sys.argv[1] == '--workers'):
+        workers = int(sys.argv[2])
+
     conn = make_connection()
     try:
         with conn.cursor() as cur:
-            compressor = Compressor(cur)
+            compressor = ParallelCompressor(cur, workers) if workers > 0 else Compressor(cur)
             try:
                 compressor.compress_all()
             finally:
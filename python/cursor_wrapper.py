@@ -1,6 +1,11 @@
+from common import get_option
+
 class CursorWrapper:
     def __init__(self, cur):
         self.cur = cur
+        self.body_dedup = bool(get_option('body_dedup', False))
+        # parse.py skips bodies parsed before (requires page_hash)
+        self.skip_unchanged = bool(get_option('skip_unchanged', False))
 
     def get_url(self, url_id):
         self.cur.execute("""select url
@@ -16,6 +21,19 @@ join directory on volume_id=directory.id
 where written is not null and url_id=%s""", (url_id,))
         row = self.cur.fetchone()
         return row[0] if row else None
-        
-    
-        
+
+    def get_body_location(self, url_id):
+        # returns (volume_id, body_hash); body_hash is set for bodies
+        # stored as shared blobs
+        if not self.body_dedup:
+            return (self.get_volume_id(url_id), None)
+
+        self.cur.execute("""select body_blob.volume_id, body_ref.hash
+from body_ref
+join body_blob on body_ref.hash=body_blob.hash
+where url_id=%s""", (url_id,))
+        row = self.cur.fetchone()
+        if row:
+            return row
+
+        return (self.get_volume_id(url_id), None)
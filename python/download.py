@@ -1,28 +1,52 @@
 #!/usr/bin/python3
 
 from datetime import datetime
+import hashlib
 from io import BytesIO
 import os
 import pycurl
 import re
 import sys
+import time
 from urllib.parse import urlparse, urlunparse
 from act_util import act_inc, act_dec
-from common import get_loose_path, get_netloc, get_option, make_connection
+from common import get_blob_lock_key, get_blob_path, get_loose_path, get_netloc, get_option, make_connection
 from download_base import DownloadBase
+from link_adder import LinkAdder
+from page_parser import HrefRecorder, PageParser
+from queue_depth import count_download_work
+from volume_holder import VolumeHolder
 
 class Target:
-    def __init__(self, owner, url, url_id):
+    def __init__(self, owner, url, url_id, host_id, volume_id=None, conditional=False, priority=0):
         self.owner = owner
         self.url = url
         self.url_id = url_id
+        self.host_id = host_id
+        self.priority = priority
+        self.volume_id = volume_id
+        self.conditional = conditional
         self.eff_id = url_id
-        self.header_target = open(get_loose_path(url_id, True), 'wb')
+        # transfers are written under temporary names, so that an
+        # interrupted one doesn't replace an earlier copy
+        self.header_part = get_loose_path(url_id, True) + '.part'
+        self.body_part = get_loose_path(url_id) + '.part'
+        if conditional:
+            # stored headers are kept if the page wasn't modified
+            self.header_target = BytesIO()
+        else:
+            self.header_target = open(self.header_part, 'wb')
+
         self.body_target = None
         self.retrieve_body = True
         self.http_code = None
         self.http_phrase = None
         self.retry_after = None
+        self.elapsed = None
+        self.failed = False
+        self.eff_url = url
+        self.recorder = HrefRecorder() if owner.inline_parse else None
+        self.hasher = hashlib.sha1() if owner.body_dedup or owner.skip_unchanged else None
 
     def write_header(self, data):
         if self.header_target.write(data) != len(data):
@@ -61,19 +85,53 @@ class Target:
     def write(self, data):
         if self.body_target is None:
             if self.retrieve_body:
-                self.body_target = open(get_loose_path(self.url_id), 'wb')
+                self.body_target = open(self.body_part, 'wb')
             else:
                 return -1
 
+        if self.recorder:
+            self.recorder.feed(data)
+
+        if self.hasher:
+            self.hasher.update(data)
+
         return self.body_target.write(data)
 
+    def is_not_modified(self):
+        return self.conditional and (self.http_code == 304)
+
     def close(self):
-        self.header_target.close()
+        if self.conditional:
+            if not self.is_not_modified():
+                with open(get_loose_path(self.url_id, True), 'wb') as f:
+                    f.write(self.header_target.getvalue())
+        else:
+            self.header_target.close()
+            os.replace(self.header_part, get_loose_path(self.url_id, True))
+
         self.header_target = None
 
         if self.body_target:
             self.body_target.close()
             self.body_target = None
+            os.replace(self.body_part, get_loose_path(self.url_id))
+
+        if self.is_not_modified():
+            self.owner.finish_fresh(self.url_id, self.eff_id)
+            self.owner.finish_work(self.host_id, self.elapsed, self.failed)
+            return
+
+        if self.volume_id is not None:
+            self.owner.unpack(self.url_id)
+
+        parsed = False
+        if self.recorder:
+            self.recorder.close()
+            if self.retrieve_body:
+                self.owner.add_page_links(self.eff_url, self.recorder.events)
+                parsed = True
+
+            self.recorder = None
 
         if self.url_id != self.eff_id:
             os.rename(get_loose_path(self.url_id, True), get_loose_path(self.eff_id, True))
@@ -85,11 +143,36 @@ class Target:
                 else:
                     os.remove(old_path)
 
-        self.owner.finish_page(self.url_id, self.eff_id, self.retrieve_body)
+        body_hash = None
+        if self.hasher and self.retrieve_body and os.path.exists(get_loose_path(self.eff_id)):
+            body_hash = self.hasher.hexdigest()
+            if self.owner.body_dedup:
+                self.owner.store_blob(self.eff_id, body_hash)
+
+        self.owner.finish_page(self.url_id, self.eff_id, self.retrieve_body, parsed, body_hash)
+        self.owner.finish_work(self.host_id, self.elapsed, self.failed)
 
+    def abort(self):
+        # transfer interrupted - the (partial) page isn't recorded and
+        # its work goes back to the queue
+        if not self.conditional:
+            self.header_target.close()
+            os.remove(self.header_part)
 
-class Retriever(DownloadBase):
+        self.header_target = None
+
+        if self.body_target:
+            self.body_target.close()
+            self.body_target = None
+            os.remove(self.body_part)
+
+        self.recorder = None
+        self.owner.abort_work(self.url_id, self.priority, self.host_id)
+
+
+class Retriever(VolumeHolder, DownloadBase):
     def __init__(self, single_action, conn, cur):
+        VolumeHolder.__init__(self)
         DownloadBase.__init__(self, conn, cur, single_action)
 
         self.max_num_conn = int(get_option('max_num_conn', "10"))
@@ -116,6 +199,17 @@ class Retriever(DownloadBase):
             else:
                 self.mime_whitelist.update(mime_whitelist.split())
 
+        # re-download only pages changed since the stored headers
+        self.conditional_recrawl = get_option('conditional_recrawl', False)
+
+        # extract links while downloading, instead of leaving pages
+        # for parse.py
+        self.inline_parse = get_option('inline_parse', False)
+        self.link_adder = LinkAdder(cur) if self.inline_parse else None
+
+        self.multi = None
+        self.share = None
+
     def is_acceptable(self, content_type):
         if len(self.mime_whitelist) == 0:
             return True
@@ -125,20 +219,36 @@ class Retriever(DownloadBase):
         return mime_type.lower() in self.mime_whitelist
 
     def retrieve_all(self):
-        while self.retrieve():
+        while self.retrieve() or self.has_inline_work():
             pass
 
+    def has_inline_work(self):
+        # links found by inline parsing don't wake us up by
+        # notification
+        if not self.link_adder:
+            return False
+
+        self.link_adder.preference.mark_batch()
+        queued = self.link_adder.queued
+        self.link_adder.queued = 0
+        return queued > 0
+
+    def add_page_links(self, url, events):
+        parser = PageParser(self.link_adder, url)
+        parser.replay(events)
+        self.link_adder.flush_links()
+
     # adapted from https://github.com/pycurl/pycurl/blob/master/examples/retriever-multi.py
     def retrieve(self):
+        self.start_round()
         avail = self.get_available_hosts()
         if not len(avail):
             return False
 
-        self.cur.execute("""select count(*)
-from download_queue
-where host_id = any(%s)""", (sorted(avail),))
-        row = self.cur.fetchone()
-        num_conn = row[0]
+        num_conn = self.count_prefetched(avail)
+        if num_conn < self.max_num_conn:
+            num_conn += count_download_work(self.cur, sorted(avail), self.max_num_conn - num_conn)
+
         if not num_conn:
             return False
 
@@ -146,39 +256,11 @@ where host_id = any(%s)""", (sorted(avail),))
         if full:
             num_conn = self.max_num_conn
 
-        m = pycurl.CurlMulti()
-        m.handles = []
-        for i in range(num_conn):
-            c = pycurl.Curl()
-            c.setopt(pycurl.FOLLOWLOCATION, 1)
-            c.setopt(pycurl.MAXREDIRS, 5)
-            c.setopt(pycurl.CONNECTTIMEOUT, 30)
-            c.setopt(pycurl.TIMEOUT, 300)
-
-            if self.accept_compressed:
-                c.setopt(pycurl.ENCODING, b'compress,gzip')
-
-            if self.force_ipv6:
-                c.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_V6)
-
-            if self.user_agent:
-                c.setopt(pycurl.USERAGENT, self.user_agent)
-
-            if self.extra_header:
-                c.setopt(pycurl.HTTPHEADER, [self.extra_header])
+        m = self.get_multi()
+        while len(m.handles) < num_conn:
+            m.handles.append(self.make_handle())
 
-            if self.socks_proxy_host:
-                c.setopt(pycurl.PROXY, self.socks_proxy_host)
-                c.setopt(pycurl.PROXYPORT, self.socks_proxy_port)
-                c.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5_HOSTNAME)
-
-            if self.http_proxy_host:
-                proxy_url = "http://%s:%d/" % (self.http_proxy_host, self.http_proxy_port)
-                c.setopt(pycurl.PROXY, proxy_url)
-
-            m.handles.append(c)
-
-        freelist = m.handles[:]
+        freelist = m.handles[:num_conn]
         num_started = 0
         num_processed = 0
         num_reported = 0
@@ -191,11 +273,19 @@ where host_id = any(%s)""", (sorted(avail),))
                 assert freelist
 
                 url_id = row[0]
-                url = self.get_url(url_id)
+                url = row[3]
                 assert url
                 c = freelist.pop()
                 num_started += 1
-                c.target = Target(self, url, url_id)
+                if self.conditional_recrawl:
+                    validators = self.get_validators(url_id, row[4])
+                    c.target = Target(self, url, url_id, row[2], row[4], len(validators) > 0, row[1])
+                    headers = [ self.extra_header ] if self.extra_header else []
+                    headers.extend(validators)
+                    c.setopt(pycurl.HTTPHEADER, headers)
+                else:
+                    c.target = Target(self, url, url_id, row[2], priority=row[1])
+
                 c.setopt(pycurl.URL, url)
                 c.setopt(c.HEADERFUNCTION, c.target.write_header)
                 c.setopt(pycurl.WRITEDATA, c.target)
@@ -224,6 +314,7 @@ where host_id = any(%s)""", (sorted(avail),))
                         clean_pr = (pr.scheme, get_netloc(pr), pr.path, pr.params, pr.query, '')
                         clean_url = urlunparse(clean_pr)
                         if target.url != clean_url:
+                            target.eff_url = clean_url
                             eff_id, known = self.add_redirect(target.url_id, clean_url)
                             target.eff_id = eff_id
                             if known:
@@ -231,9 +322,10 @@ where host_id = any(%s)""", (sorted(avail),))
 
                     msg = "got " + eff_url
                     added_hold = False
-                    if target.http_code != 200:
-                        self.cur.execute("""insert into download_error(url_id, error_code, error_message, failed)
-values(%s, %s, %s, localtimestamp)""", (target.url_id, target.http_code, target.http_phrase))
+                    if target.is_not_modified():
+                        msg += " not modified"
+                    elif target.http_code != 200:
+                        self.add_error(target.url_id, target.http_code, target.http_phrase)
 
                         # HTTP 429 response need not include
                         # Retry-After (apparently it depends on the
@@ -259,12 +351,18 @@ values(%s, %s, %s, localtimestamp)""", (target.url_id, target.http_code, target.
                     if added_hold:
                         print("added hold on " + eff_hostname, file=sys.stderr)
 
+                    self.record_outcome(target.host_id, not target.is_not_modified() and (target.http_code != 200))
+                    target.elapsed = c.getinfo(pycurl.TOTAL_TIME)
+                    target.failed = (target.http_code is None) or (target.http_code == 429) or (target.http_code >= 500)
                     target.close()
                     c.target = None
                     freelist.append(c)
 
                 for c, errno, errmsg in err_list:
                     target = c.target
+                    # 23 is the write error of a body we didn't want
+                    target.failed = (errno != 23) or target.retrieve_body
+                    self.record_outcome(target.host_id, target.failed)
                     target.close()
                     c.target = None
                     m.remove_handle(c)
@@ -276,24 +374,192 @@ values(%s, %s, %s, localtimestamp)""", (target.url_id, target.http_code, target.
                 if num_q == 0:
                     break
 
+            self.write_behind.cond_flush()
+
             if (num_processed - num_reported) >= self.notification_threshold:
                 self.cond_notify()
                 num_reported = num_processed
 
             if num_started == num_processed:
-                break
+                # nothing in progress - but there might be work
+                # waiting for a per-host rate limit
+                delay = self.get_throttle_delay()
+                if delay is None:
+                    break
 
-            m.select(1.0)
+                time.sleep(delay)
+            else:
+                m.select(1.0)
 
-        for c in m.handles:
-            if hasattr(c, 'target') and (c.target is not None):
-                c.target.close()
-                c.target = None
+        self.flush()
+        return full
 
-            c.close()
+    def get_multi(self):
+        # kept between rounds, so that connections, TLS sessions and
+        # resolved names can be reused
+        if self.multi is None:
+            self.share = pycurl.CurlShare()
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            # libcurl 7.57+
+            if hasattr(pycurl, 'LOCK_DATA_CONNECT'):
+                self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+
+            self.multi = pycurl.CurlMulti()
+            self.multi.handles = []
+
+        return self.multi
+
+    def make_handle(self):
+        c = pycurl.Curl()
+        c.setopt(pycurl.SHARE, self.share)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 5)
+        c.setopt(pycurl.CONNECTTIMEOUT, 30)
+        c.setopt(pycurl.TIMEOUT, 300)
+
+        if self.accept_compressed:
+            c.setopt(pycurl.ENCODING, b'compress,gzip')
+
+        if self.force_ipv6:
+            c.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_V6)
+
+        if self.user_agent:
+            c.setopt(pycurl.USERAGENT, self.user_agent)
+
+        if self.extra_header:
+            c.setopt(pycurl.HTTPHEADER, [self.extra_header])
+
+        if self.socks_proxy_host:
+            c.setopt(pycurl.PROXY, self.socks_proxy_host)
+            c.setopt(pycurl.PROXYPORT, self.socks_proxy_port)
+            c.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5_HOSTNAME)
+
+        if self.http_proxy_host:
+            proxy_url = "http://%s:%d/" % (self.http_proxy_host, self.http_proxy_port)
+            c.setopt(pycurl.PROXY, proxy_url)
+
+        c.target = None
+        return c
+
+    def store_blob(self, url_id, body_hash):
+        # The body is kept once per hash, the page refers to it. The
+        # ref is written right away, under the hash's lock, so that the
+        # blob can't be released before the page uses it.
+        loose_path = get_loose_path(url_id)
+        blob_path = get_blob_path(body_hash)
+        lock_key = get_blob_lock_key(body_hash)
+        self.cur.execute("""select pg_advisory_lock(%s)""", (lock_key,))
+        try:
+            self.cur.execute("""select hash
+from body_ref
+where url_id=%s""", (url_id,))
+            row = self.cur.fetchone()
+            old_hash = row[0] if row else None
+
+            self.cur.execute("""with blob as (
+        insert into body_blob(hash)
+        values(%s)
+        on conflict do nothing
+)
+insert into body_ref(url_id, hash)
+values(%s, %s)
+on conflict(url_id) do update
+set hash=excluded.hash""", (body_hash, url_id, body_hash))
+
+            # linked before checking the volume: compress.py records
+            # the volume before removing packed blobs' files
+            try:
+                os.link(loose_path, blob_path)
+            except FileExistsError:
+                pass
+
+            self.cur.execute("""select volume_id
+from body_blob
+where hash=%s""", (body_hash,))
+            row = self.cur.fetchone()
+            if row[0] is not None:
+                # already packed - nothing would remove another copy
+                try:
+                    os.remove(blob_path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            self.cur.execute("""select pg_advisory_unlock(%s)""", (lock_key,))
+
+        os.remove(loose_path)
+        self.write_behind.add_stored(url_id)
+        if old_hash and (old_hash != body_hash):
+            self.write_behind.release_blobs([ old_hash ])
+
+    def get_validators(self, url_id, volume_id):
+        reader = self.open_headers(url_id, volume_id)
+        if reader is None:
+            return []
+
+        http_code = None
+        etag = None
+        last_modified = None
+        try:
+            for ln in reader:
+                header_line = ln.decode('iso-8859-1').strip()
+                if header_line.startswith('HTTP/'):
+                    # the last response (after redirects) is what counts
+                    line_list = header_line.split()
+                    http_code = line_list[1] if len(line_list) >= 2 else None
+                    etag = None
+                    last_modified = None
+                else:
+                    line_list = header_line.split(':', 1)
+                    if len(line_list) == 2:
+                        name, value = line_list
+                        name = name.strip()
+                        name = name.lower()
+                        value = value.strip()
+
+                        if name == 'etag':
+                            etag = value
+                        elif name == 'last-modified':
+                            last_modified = value
+        finally:
+            reader.close()
+
+        validators = []
+        if http_code == '200':
+            if etag:
+                validators.append("If-None-Match: " + etag)
+
+            if last_modified:
+                validators.append("If-Modified-Since: " + last_modified)
+
+        return validators
 
-        m.close()
-        return full
+    def close(self):
+        try:
+            if self.multi is not None:
+                for c in self.multi.handles:
+                    if c.target is not None:
+                        self.multi.remove_handle(c)
+                        c.target.abort()
+                        c.target = None
+
+            # before flushing, which is what fails when the database
+            # connection is lost
+            self.release_prefetched()
+            self.flush()
+        finally:
+            VolumeHolder.close(self)
+            if self.link_adder:
+                self.link_adder.close_links()
+
+            if self.multi is not None:
+                for c in self.multi.handles:
+                    c.close()
+
+                self.multi.close()
+                self.multi = None
+                self.share.close()
+                self.share = None
 
     def report_error(self, target, errno, errmsg):
         if (errno == 23) and not target.retrieve_body:
@@ -301,8 +567,7 @@ values(%s, %s, %s, localtimestamp)""", (target.url_id, target.http_code, target.
             return
 
         print("Failed:", errno, errmsg, file=sys.stderr)
-        self.cur.execute("""insert into download_error(url_id, error_code, error_message, failed)
-values(%s, %s, %s, localtimestamp)""", (target.url_id, errno, errmsg))
+        self.add_error(target.url_id, errno, errmsg)
 
 
 def main():
@@ -312,20 +577,23 @@ def main():
     try:
         with conn.cursor() as cur:
             retriever = Retriever(single_action, conn, cur)
-            while True:
-                act_inc(cur)
-                retriever.retrieve_all()
-                global_live = act_dec(cur)
-                if single_action:
-                    break
-                else:
-                    future_live = retriever.cond_notify()
-                    if global_live or future_live or retriever.has_holds():
-                        retriever.wait()
-                    else:
-                        retriever.last_notify()
-                        print("all done", file=sys.stderr)
+            try:
+                while True:
+                    act_inc(cur)
+                    retriever.retrieve_all()
+                    global_live = act_dec(cur)
+                    if single_action:
                         break
+                    else:
+                        future_live = retriever.cond_notify()
+                        if global_live or future_live or retriever.has_holds():
+                            retriever.wait()
+                        else:
+                            retriever.last_notify()
+                            print("all done", file=sys.stderr)
+                            break
+            finally:
+                retriever.close()
     finally:
         conn.close()
 
@@ -3,7 +3,11 @@ import select
 import sys
 import time
 from common import get_option
+from frontier import Frontier
 from host_check import get_parse_notification_name, HostCheck
+from outcome_window import OutcomeWindow
+from queue_depth import has_parse_work
+from write_behind import WriteBehind
 
 class DownloadBase(HostCheck):
     def __init__(self, conn, cur, single_action):
@@ -12,14 +16,29 @@ class DownloadBase(HostCheck):
 
         self.conn = conn
         self.single_action = single_action
-        self.host_id = 0
-        self.max_host_id = self.get_max_host()
         self.notification_relay = get_option("notification_relay", None)
 
+        # per-page bookkeeping is written in batches, when enough
+        # pages finished or enough time elapsed
+        self.write_behind = WriteBehind(cur, self.inst_id, int(get_option("write_behind_size", "100")), float(get_option("write_behind_interval", "2")), self.body_dedup)
+
         # according to HTTP spec, Retry-After can also have absolute
         # time value, but that had not been seen yet
         self.relative_rx = re.compile("^([0-9]{1,3})$")
         self.holds = {} # host_id -> int time in secs
+        # download_queue rows are claimed in batches into per-host
+        # in-memory queues, served round-robin subject to per-host
+        # rate and concurrency limits; with the default batch of 1,
+        # rows are claimed one at a time, only when they can start
+        self.claim_batch = int(get_option("download_claim_batch", "1"))
+        self.last_host_id = 0 # round-robin position of single claims
+        self.throttled = None # delay of hosts skipped by the last single claim
+        self.frontier = Frontier(float(get_option("host_rate", "0")), max(1, int(get_option("host_burst", "1"))), int(get_option("host_max_in_flight", "0")),
+            bool(get_option("adaptive_concurrency", False)), max(1, int(get_option("host_initial_window", "2"))), float(get_option("host_latency_factor", "3")))
+        self.adaptive_backoff = int(get_option("adaptive_backoff", "30"))
+        self.frontier_recheck = float(get_option("frontier_recheck", "5"))
+        self.drained = {} # host_id -> time of last empty refill
+        self.aborted = [] # of (url_id, priority, host_id) claimed but not finished
         self.last_expiration = int(time.time() + 0.5)
         self.counter = 0
         self.healthcheck_interval = int(get_option("healthcheck_interval", "100"))
@@ -29,13 +48,12 @@ class DownloadBase(HostCheck):
             # disabled
             self.healthcheck_interval = 0
 
-    def get_max_host(self):
-        mx = 0
-        for _, host_id in self.host_white.items():
-            if host_id > mx:
-                mx = host_id
-
-        return mx
+        # outcomes of this process' downloads, so that checking them
+        # doesn't depend on crawl size
+        self.outcomes = OutcomeWindow(max(1, self.healthcheck_tail))
+        # seconds between summaries of them, for monitoring
+        self.health_stats_interval = float(get_option("health_stats_interval", "0"))
+        self.last_health_stats = time.time()
 
     def get_available_hosts(self):
         self.cond_expire()
@@ -57,12 +75,7 @@ class DownloadBase(HostCheck):
                     relative = int(m.group(1))
 
             if relative is not None:
-                now = self.cond_expire()
-                future = now + relative
-                old = self.holds.get(host_id)
-                if (old is None) or (old < future):
-                    self.holds[host_id] = future
-                    return True
+                return self.add_host_hold(host_id, relative)
             else:
                 print("do not understand Retry-After: " + retry_after, file=sys.stderr)
         else:
@@ -70,47 +83,168 @@ class DownloadBase(HostCheck):
 
         return False
 
+    def add_host_hold(self, host_id, relative):
+        now = self.cond_expire()
+        future = now + relative
+        old = self.holds.get(host_id)
+        if (old is None) or (old < future):
+            self.holds[host_id] = future
+            return True
+
+        return False
+
     def pop_work_item(self):
         avail = self.get_available_hosts()
         if not len(avail):
             return None
 
-        last_tops = None
-        while True:
-            tops = [ hid for hid in avail if hid > self.host_id ]
-            tops.sort()
-            row = None
-            if len(tops) and (tops != last_tops):
-                last_tops = tops
-                # https://blog.2ndquadrant.com/what-is-select-skip-locked-for-in-postgresql-9-5/
-                self.cur.execute("""delete from download_queue
-where url_id = (
-        select url_id
-        from download_queue
-        where host_id = any(%s)
-        order by host_id, priority, url_id
-        for update skip locked
-        limit 1
+        now = time.time()
+        if self.claim_batch <= 1:
+            row = self.claim_single(avail, now)
+        else:
+            # hosts with nothing buffered are refilled in bulk, but not
+            # re-checked too often when the database didn't have
+            # anything for them
+            empty = [ hid for hid in avail if not self.frontier.has_queued(hid) and (self.drained.get(hid, 0) + self.frontier_recheck <= now) ]
+            if empty:
+                self.prefetch(empty, now)
+
+            row = self.frontier.pop(avail, now)
+
+        if row:
+            if self.healthcheck_interval > 0:
+                self.counter += 1
+                if (self.counter >= self.healthcheck_tail) and not(self.counter % self.healthcheck_interval):
+                    # when the check fails, the row goes back to the queue
+                    self.aborted.append(row[:3])
+                    self.healthcheck()
+                    self.aborted.pop()
+
+        return row
+
+    def start_round(self):
+        # somebody might have added work since the last check
+        self.drained.clear()
+
+    def finish_work(self, host_id, elapsed=None, failed=False):
+        self.frontier.finish(host_id)
+        if self.frontier.adaptive and ((elapsed is not None) or failed):
+            if self.frontier.report(host_id, elapsed, failed) and (self.adaptive_backoff > 0):
+                # already down to one connection - pause the host
+                if self.add_host_hold(host_id, self.adaptive_backoff):
+                    print("added backoff hold on host %d" % (host_id,), file=sys.stderr)
+
+    def get_throttle_delay(self):
+        if self.claim_batch <= 1:
+            return self.throttled
+
+        avail = self.get_available_hosts()
+        return self.frontier.get_delay(avail, time.time())
+
+    def claim_single(self, avail, now):
+        # hosts which can start a download now, those after the last
+        # one served first
+        hosts = []
+        self.throttled = None
+        for host_id in sorted(avail):
+            delay = self.frontier.get_host_delay(host_id, now)
+            if delay == 0:
+                hosts.append(host_id)
+            elif (delay is not None) and ((self.throttled is None) or (self.throttled > delay)):
+                self.throttled = delay
+
+        tops = [ hid for hid in hosts if hid > self.last_host_id ]
+        attempts = [ tops ] if tops else []
+        if len(tops) < len(hosts):
+            attempts.append(hosts)
+
+        for candidates in attempts:
+            # https://blog.2ndquadrant.com/what-is-select-skip-locked-for-in-postgresql-9-5/
+            self.cur.execute("""with claimed as (
+        delete from download_queue
+        where url_id = (
+                select url_id
+                from download_queue
+                where host_id = any(%s)
+                order by host_id, priority, url_id
+                for update skip locked
+                limit 1
+        )
+        returning url_id, priority, host_id
 )
-returning url_id""", (tops,))
-                row = self.cur.fetchone()
-                if row:
-                    self.host_id += 1
-                    if self.host_id >= self.max_host_id:
-                        self.host_id = 0
+select claimed.url_id, priority, host_id, url, volume_id
+from claimed
+left join field on claimed.url_id=field.id
+left join (
+        content
+        join directory on volume_id=directory.id and written is not null
+) on claimed.url_id=content.url_id""", (candidates,))
+            row = self.cur.fetchone()
+            if row:
+                self.last_host_id = row[2]
+                self.throttled = None
+                self.frontier.start(row[2])
+                return row
+
+        return None
+
+    def prefetch(self, hosts, now):
+        hosts.sort()
+        per_host = (self.claim_batch + len(hosts) - 1) // len(hosts)
+        # https://blog.2ndquadrant.com/what-is-select-skip-locked-for-in-postgresql-9-5/
+        self.cur.execute("""with claimed as (
+        delete from download_queue
+        where url_id in (
+                select q.url_id
+                from unnest(%s::integer[]) as h(id)
+                cross join lateral (
+                        select url_id
+                        from download_queue
+                        where host_id=h.id
+                        order by priority, url_id
+                        for update skip locked
+                        limit %s
+                ) q
+        )
+        returning url_id, priority, host_id
+)
+select claimed.url_id, priority, host_id, url, volume_id
+from claimed
+left join field on claimed.url_id=field.id
+left join (
+        content
+        join directory on volume_id=directory.id and written is not null
+) on claimed.url_id=content.url_id
+order by priority, claimed.url_id""", (hosts, per_host))
+        rows = self.cur.fetchall()
+        for row in rows:
+            self.frontier.add(row)
+
+        for host_id in hosts:
+            if self.frontier.has_queued(host_id):
+                self.drained.pop(host_id, None)
+            else:
+                self.drained[host_id] = now
 
-                    if self.healthcheck_interval > 0:
-                        self.counter += 1
-                        if (self.counter >= self.healthcheck_tail) and not(self.counter % self.healthcheck_interval):
-                            self.healthcheck()
+    def count_prefetched(self, avail):
+        return self.frontier.count(avail)
 
-                    return row
+    def abort_work(self, url_id, priority, host_id):
+        self.frontier.finish(host_id)
+        self.aborted.append((url_id, priority, host_id))
 
-            if row is None:
-                if self.host_id > 0:
-                    self.host_id = 0
-                else:
-                    return None
+    def release_prefetched(self):
+        rows = self.frontier.drain()
+        rows.extend(self.aborted)
+        self.aborted = []
+        if not rows:
+            return
+
+        print("returning %d prefetched or interrupted item(s) to queue" % (len(rows),), file=sys.stderr)
+        self.cur.execute("""insert into download_queue(url_id, priority, host_id)
+select *
+from unnest(%s::integer[], %s::integer[], %s::integer[])
+on conflict do nothing""", ([ row[0] for row in rows ], [ row[1] for row in rows ], [ row[2] for row in rows ]))
 
     def add_redirect(self, url_id, new_url):
         known = False
@@ -142,65 +276,44 @@ on conflict do nothing""", (url_id, new_url_id))
 
         return (new_url_id, known)
 
-    def finish_page(self, url_id, eff_id, has_body):
-        self.finish_url(url_id, True)
+    def finish_page(self, url_id, eff_id, has_body, parsed=False, body_hash=None):
+        self.write_behind.add_checked(url_id, True)
         if url_id != eff_id:
-            self.finish_url(eff_id, False)
-
-        if has_body:
-            self.cur.execute("""insert into parse_queue(url_id) values(%s)
-on conflict(url_id) do nothing""", (eff_id,))
-
-    def finish_url(self, url_id, upd_inst):
-        if self.inst_id:
-            # Mostly there should be no existing record.
-            if upd_inst:
-                # When there is (e.g. after restarting download), the
-                # download locality should be updated.
-                self.cur.execute("""insert into locality(url_id, instance_id)
-values(%s, %s)
-on conflict(url_id) do update
-set instance_id=%s""", (url_id, self.inst_id, self.inst_id))
-            else:
-                # On the other hand, if somebody (e.g. sync.py)
-                # changed instance after download, hopefully they knew
-                # what they were doing...
-                self.cur.execute("""insert into locality(url_id, instance_id)
-values(%s, %s)
-on conflict(url_id) do nothing
-returning url_id""", (url_id, self.inst_id))
-                row = self.cur.fetchone()
-                if row is None:
-                    self.cur.execute("""select instance_id
-from locality
-where url_id=%s""", (url_id,))
-                    row = self.cur.fetchone()
-                    if row[0] != self.inst_id:
-                        print("cannot change instance of %d (from %d to %d)" % (url_id, row[0], self.inst_id), file=sys.stderr)
-        # correct but unnecessary work (provided that either every
-        # config used for a download has an instance, or none do)
-#         else:
-#             if upd_inst:
-#                 self.cur.execute("""delete from locality
-# where url_id=%s""", (url_id,))
-
-        self.cur.execute("""update field
-set checkd=localtimestamp
-where id=%s""", (url_id,))
+            self.write_behind.add_checked(eff_id, False)
+
+        if body_hash and self.skip_unchanged:
+            self.write_behind.add_hash(eff_id, body_hash, parsed)
+
+        if parsed:
+            self.write_behind.add_parsed(eff_id)
+        elif has_body:
+            self.write_behind.add_parsable(eff_id)
+
+        self.write_behind.cond_flush()
+
+    def finish_fresh(self, url_id, eff_id):
+        # not modified since the last download - stored page stays
+        self.write_behind.add_fresh(url_id)
+        if url_id != eff_id:
+            self.write_behind.add_fresh(eff_id)
+
+        self.write_behind.cond_flush()
+
+    def unpack(self, url_id):
+        # newly downloaded page replaces its compressed version
+        self.write_behind.add_unpacked(url_id)
+
+    def add_error(self, url_id, error_code, error_message):
+        self.write_behind.add_error(url_id, error_code, error_message)
+
+    def flush(self):
+        self.write_behind.flush()
 
     def cond_notify(self):
+        self.flush()
         live = False
         if not self.single_action:
-            sql = """select count(*)
-from parse_queue"""
-            if self.inst_id:
-                sql += """
-join locality on parse_queue.url_id=locality.url_id
-where instance_id=%d""" % self.inst_id
-
-            self.cur.execute(sql)
-            row = self.cur.fetchone()
-            live = row[0] > 0
+            live = has_parse_work(self.cur, self.inst_id)
             if live:
                 self.do_notify()
 
@@ -210,11 +323,13 @@ where instance_id=%d""" % self.inst_id
         self.cur.execute("""notify %s""" % get_parse_notification_name(self.inst_id))
 
     def last_notify(self):
+        self.flush()
         self.do_notify()
         if self.notification_relay:
             self.cur.execute("""notify download_ready""")
 
     def wait(self):
+        self.flush()
         timeout = self.get_interval()
         self.cur.execute("""listen download_ready""")
         if timeout is None:
@@ -260,35 +375,33 @@ where instance_id=%d""" % self.inst_id
 
         return now
 
+    def record_outcome(self, host_id, failed):
+        self.outcomes.add(host_id, failed)
+        if self.health_stats_interval > 0:
+            now = time.time()
+            if now >= self.last_health_stats + self.health_stats_interval:
+                self.last_health_stats = now
+                self.print_health_stats()
+
+    def get_health_stats(self):
+        return self.outcomes.get_stats()
+
+    def print_health_stats(self):
+        stats = self.get_health_stats()
+        count, failed = stats[None]
+        print("health: failed on %d of the last %d downloads" % (failed, count), file=sys.stderr)
+        for host_id, counts in sorted(stats.items(), key=lambda kv: kv[0] or 0):
+            if host_id is not None:
+                print("  host %d: failed on %d of %d" % (host_id, counts[1], counts[0]), file=sys.stderr)
+
     def healthcheck(self):
         print("checking success rate...", file=sys.stderr)
-        if not self.inst_id:
-            q = """select count(*)
-from (
-        select id
-        from field
-        where checkd is not null
-        order by checkd desc
-        limit %d
-) sq
-join download_error on id=url_id""" % self.healthcheck_tail
-        else:
-            q = """select count(*)
-from (
-        select id
-        from field
-        join locality on id=url_id
-        where checkd is not null and instance_id=%d
-        order by checkd desc
-        limit %d
-) sq
-join download_error on id=url_id""" % (self.inst_id, self.healthcheck_tail)
-
-        self.cur.execute(q)
-        row = self.cur.fetchone()
-        err_count = row[0]
+        err_count = self.outcomes.get_failed()
         msg = "on the last %d downloads, failed on %d" % (self.healthcheck_tail, err_count)
         if err_count >= self.healthcheck_threshold:
             raise Exception(msg)
         elif err_count > 0:
             print(msg, file=sys.stderr)
+            for host_id, counts in sorted(self.get_health_stats().items(), key=lambda kv: kv[0] or 0):
+                if (host_id is not None) and counts[1]:
+                    print("  host %d: failed on %d of %d" % (host_id, counts[1], counts[0]), file=sys.stderr)
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import time
 from act_util import act_inc, act_dec
 from selenium import webdriver
 from selenium.common import exceptions
@@ -10,6 +11,7 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from common import get_loose_path, get_option, get_parent_directory, make_connection
 from download_base import DownloadBase
+from queue_depth import has_download_work
 
 class Driver(DownloadBase):
     def __init__(self, single_action, conn, cur):
@@ -43,20 +45,17 @@ class Driver(DownloadBase):
         self.br = webdriver.Chrome(executable_path='chromedriver', options=options)
 
     def run(self):
-        self.cur.execute("""select count(*)
-from download_queue""")
-        row = self.cur.fetchone()
-        num_conn = row[0]
-        if not num_conn:
+        if not has_download_work(self.cur) and not self.count_prefetched(self.get_available_hosts()):
             return
 
         self.lazy_init()
+        self.start_round()
 
         batch_processed = 0
-        row = self.pop_work_item()
+        row = self.pop_ready_item()
         while row:
             url_id = row[0]
-            url = self.get_url(url_id)
+            url = row[3]
             self.br.get(url)
             error_code = None
             try:
@@ -91,14 +90,31 @@ set error_code=%s, failed=localtimestamp""", (url_id, error_code, error_code))
                 self.lazy_init()
 
             self.finish_page(url_id, eff_id, not error_code)
+            self.finish_work(row[2])
+            self.record_outcome(row[2], bool(error_code))
 
             batch_processed += 1
             if batch_processed >= self.notification_threshold:
                 self.cond_notify()
                 batch_processed = 0
 
+            row = self.pop_ready_item()
+
+        self.flush()
+
+    def pop_ready_item(self):
+        row = self.pop_work_item()
+        while row is None:
+            # there might be work waiting for a per-host rate limit
+            delay = self.get_throttle_delay()
+            if delay is None:
+                break
+
+            time.sleep(delay)
             row = self.pop_work_item()
 
+        return row
+
     def close(self):
         if self.br:
             self.br.close()
@@ -111,21 +127,25 @@ def main():
     try:
         with conn.cursor() as cur:
             driver = Driver(single_action, conn, cur)
-            while True:
-                act_inc(cur)
-                driver.run()
-                global_live = act_dec(cur)
-                if single_action:
-                    break
-                else:
-                    future_live = driver.cond_notify()
-                    if global_live or future_live:
-                        driver.wait()
-                    else:
-                        driver.last_notify()
-                        driver.close()
-                        print("all done")
+            try:
+                while True:
+                    act_inc(cur)
+                    driver.run()
+                    global_live = act_dec(cur)
+                    if single_action:
                         break
+                    else:
+                        future_live = driver.cond_notify()
+                        if global_live or future_live:
+                            driver.wait()
+                        else:
+                            driver.last_notify()
+                            driver.close()
+                            print("all done")
+                            break
+            finally:
+                driver.release_prefetched()
+                driver.flush()
     finally:
         conn.close()
 
@@ -14,12 +14,11 @@ class Dumper(VolumeHolder, CursorWrapper):
         self.dump_header = dump_header
 
     def dump(self, url, url_id):
-        volume_id = self.get_volume_id(url_id)
-
         if not self.dump_header:
-            reader = self.open_page(url_id, volume_id)
+            volume_id, body_hash = self.get_body_location(url_id)
+            reader = self.open_page(url_id, volume_id, body_hash)
         else:
-            reader = self.open_headers(url_id, volume_id)
+            reader = self.open_headers(url_id, self.get_volume_id(url_id))
 
         if reader:
             try:
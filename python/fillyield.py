@@ -5,7 +5,7 @@ from path_builder import PathBuilder
 
 class Adder(PathBuilder):
     def __init__(self, cur):
-        PathBuilder.__init__(self, cur, int(get_option('path_cache_high_mark', "2000")), int(get_option('path_cache_low_mark', "1000")))
+        PathBuilder.__init__(self, cur, int(get_option('path_cache_high_mark', "2000")))
 
         print("resetting yields...")
         self.cur.execute("""update nodes
@@ -44,6 +44,9 @@ order by url""", (paydirt,))
             rows = cur.fetchall()
             for row in rows:
                 adder.add(*row)
+
+            if adder.cache is not None:
+                print("path cache: " + adder.cache.get_stats())
     finally:
         conn.close()
 
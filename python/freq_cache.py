@@ -0,0 +1,53 @@
+class FreqCache:
+    # Bounded map evicting rarely used keys (GCLOCK): every hit adds
+    # to the key's weight, the clock hand takes it back while looking
+    # for a key to evict, so eviction is O(1) amortized.
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        self.entries = {} # key -> [value, weight]
+        self.ring = [] # of keys, in slot order
+        self.hand = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        entry[1] += 1
+        return entry[0]
+
+    def put(self, key, value):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[0] = value
+            return
+
+        if len(self.ring) < self.capacity:
+            self.ring.append(key)
+        else:
+            self.evict()
+            self.ring[self.hand] = key
+            self.hand = (self.hand + 1) % self.capacity
+
+        self.entries[key] = [value, 0]
+
+    def evict(self):
+        while True:
+            entry = self.entries[self.ring[self.hand]]
+            if entry[1] <= 0:
+                del self.entries[self.ring[self.hand]]
+                return
+
+            entry[1] -= 1
+            self.hand = (self.hand + 1) % self.capacity
+
+    def get_stats(self):
+        return "%d hits, %d misses, %d entries" % (self.hits, self.misses, len(self.entries))
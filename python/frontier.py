@@ -0,0 +1,163 @@
+from collections import deque
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def get_delay(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class HostWindow:
+    # AIMD: grows by about 1 per window of healthy responses, halves
+    # on failure
+    def __init__(self, size, latency_factor):
+        self.size = size
+        self.latency_factor = latency_factor
+        self.latency = None # exponential moving average, in secs
+        self.best_latency = None
+
+    def get_limit(self):
+        return int(self.size)
+
+    def on_success(self, elapsed, cap):
+        if elapsed is not None:
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            if (self.best_latency is None) or (self.best_latency > elapsed):
+                self.best_latency = elapsed
+
+            if self.latency > self.latency_factor * max(self.best_latency, 0.001):
+                # slowing down - keep the window as it is
+                return
+
+        self.size = min(cap, self.size + 1.0 / self.size)
+
+    def on_failure(self):
+        self.size = max(1.0, self.size / 2)
+
+class Frontier:
+    def __init__(self, rate, burst, max_in_flight, adaptive=False, initial_window=2, latency_factor=3.0):
+        self.rate = rate # 0 => unlimited
+        self.burst = burst
+        self.max_in_flight = max_in_flight # 0 => unlimited
+        self.queues = {} # host_id -> deque of work items
+        self.ready = deque() # host IDs with non-empty queues, in round-robin order
+        self.buckets = {} # host_id -> TokenBucket
+        self.in_flight = {} # host_id -> int
+        self.adaptive = adaptive
+        self.initial_window = initial_window
+        self.latency_factor = latency_factor
+        self.windows = {} # host_id -> HostWindow
+
+    def add(self, row):
+        host_id = row[2]
+        q = self.queues.get(host_id)
+        if q is None:
+            q = deque()
+            self.queues[host_id] = q
+
+        if not q:
+            self.ready.append(host_id)
+
+        q.append(row)
+
+    def has_queued(self, host_id):
+        q = self.queues.get(host_id)
+        return bool(q)
+
+    def count(self, avail):
+        return sum(len(self.queues[host_id]) for host_id in self.ready if host_id in avail)
+
+    def pop(self, avail, now):
+        for i in range(len(self.ready)):
+            host_id = self.ready[0]
+            self.ready.rotate(-1)
+            if (host_id in avail) and (self.get_host_delay(host_id, now) == 0):
+                q = self.queues[host_id]
+                row = q.popleft()
+                if not q:
+                    # just rotated to the end
+                    self.ready.pop()
+
+                self.start(host_id)
+                return row
+
+        return None
+
+    def start(self, host_id):
+        # after get_host_delay returned 0
+        if self.rate > 0:
+            self.buckets[host_id].take()
+
+        self.in_flight[host_id] = self.in_flight.get(host_id, 0) + 1
+
+    def finish(self, host_id):
+        cnt = self.in_flight.get(host_id, 0)
+        if cnt > 1:
+            self.in_flight[host_id] = cnt - 1
+        elif cnt:
+            del self.in_flight[host_id]
+
+    def get_window(self, host_id):
+        window = self.windows.get(host_id)
+        if window is None:
+            window = HostWindow(self.initial_window, self.latency_factor)
+            self.windows[host_id] = window
+
+        return window
+
+    def report(self, host_id, elapsed, failed):
+        # returns True when the host keeps failing at the minimal
+        # window
+        window = self.get_window(host_id)
+        if failed:
+            exhausted = window.get_limit() <= 1
+            window.on_failure()
+            return exhausted
+        else:
+            window.on_success(elapsed, self.max_in_flight if self.max_in_flight else float('inf'))
+            return False
+
+    def get_host_delay(self, host_id, now):
+        # None => blocked until something finishes
+        limit = self.get_window(host_id).get_limit() if self.adaptive else self.max_in_flight
+        if limit and (self.in_flight.get(host_id, 0) >= limit):
+            return None
+
+        if self.rate <= 0:
+            return 0
+
+        bucket = self.buckets.get(host_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self.buckets[host_id] = bucket
+
+        return bucket.get_delay(now)
+
+    def get_delay(self, avail, now):
+        mn = None
+        for host_id in self.ready:
+            if host_id in avail:
+                delay = self.get_host_delay(host_id, now)
+                if (delay is not None) and ((mn is None) or (mn > delay)):
+                    mn = delay
+
+        return mn
+
+    def drain(self):
+        rows = []
+        for host_id in self.ready:
+            rows.extend(self.queues[host_id])
+            self.queues[host_id].clear()
+
+        self.ready.clear()
+        return rows
@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 
 import sys
-from urllib.parse import urlparse, urlunparse
-from common import get_netloc, make_connection, normalize_url_component
+from body_cache import make_body_cache
+from common import get_option, make_connection
+from row_stream import stream_rows
 from host_check import HostCheck
 from page_parser import PageParser
+from url_normalizer import UrlNormalizer
 from volume_holder import VolumeHolder
 
 class Builder(VolumeHolder, HostCheck):
@@ -12,33 +14,36 @@ class Builder(VolumeHolder, HostCheck):
         VolumeHolder.__init__(self)
         HostCheck.__init__(self, cur)
         self.children = None
+        self.normalizer = UrlNormalizer(int(get_option('url_cache_size', "10000")))
+        self.body_cache = make_body_cache()
 
     def add(self, url, url_id):
         print("adding " + url + "...", file=sys.stderr)
 
-        volume_id = self.get_volume_id(url_id)
-        f = self.open_page(url_id, volume_id)
+        volume_id, body_hash = self.get_body_location(url_id)
+        f = self.open_page(url_id, volume_id, body_hash)
         if f is not None:
-            self.parse_file(url, f)
+            self.parse_file(url, f, body_hash)
             self.insert_links(url_id)
         else:
             self.cond_insert_redir(url_id)
 
-    def parse_file(self, url, page_file):
+    def parse_file(self, url, page_file, body_hash=None):
         try:
             self.children = set()
             parser = PageParser(self, url)
-            parser.parse_links(page_file)
+            if self.body_cache:
+                parser.replay(self.body_cache.get_events(page_file, body_hash))
+            else:
+                parser.parse_links(page_file)
         finally:
             page_file.close()
 
     def add_link(self, url):
-        pr = urlparse(url.strip())
-        if pr.hostname: # may not exist even for valid links, e.g. mailto:
-            host_id = self.get_host_id(pr.hostname)
-            if host_id:
-                clean_pr = (pr.scheme, get_netloc(pr), normalize_url_component(pr.path), pr.params, normalize_url_component(pr.query), '')
-                clean_url = urlunparse(clean_pr)
+        hostname, clean_pr, clean_url = self.normalizer.normalize(url)
+        if hostname: # may not exist even for valid links, e.g. mailto:
+            host_id = self.get_host_id(hostname)
+            if host_id and clean_url:
                 child_url_id = self.get_url_id(clean_url)
                 if child_url_id:
                     self.children.add(child_url_id)
@@ -87,13 +92,11 @@ def main():
         with conn.cursor() as cur:
             builder = Builder(cur)
             try:
-                cur.execute("""select url, id
+                for row in stream_rows("""select url, id
 from field
 left join nodes on id=url_id
 where checkd is not null and (url_id is null or depth=0)
-order by url""")
-                rows = cur.fetchall()
-                for row in rows:
+order by url"""):
                     builder.add(*row)
             finally:
                 builder.close()
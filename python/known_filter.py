@@ -0,0 +1,229 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from common import get_filter_path, get_option
+
+header_format = '<8sQQq' # magic, capacity, count, max_id
+header_size = struct.calcsize(header_format)
+magic = b'ampknow1'
+max_load = 0.75
+sync_batch = 10000
+
+def hash_url(url):
+    h = int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+    return h if h else 1 # 0 marks an empty slot
+
+class KnownFilter:
+    # Set of 64-bit URL hashes in a memory-mapped open-addressing
+    # table, shared by all processes using the same table. A hash
+    # collision would make a new URL look known, but that's improbable
+    # enough to ignore; URLs missing in the set (e.g. inserted by
+    # another process since the last sync) just cost a DB lookup.
+    def __init__(self, cur, table, capacity):
+        self.cur = cur
+        self.table = table
+        self.path = get_filter_path(table)
+        self.min_capacity = 1
+        while self.min_capacity < capacity:
+            self.min_capacity *= 2
+
+        self.fd = None
+        self.mm = None
+        self.slots = None
+        self.lock()
+        try:
+            self.sync()
+        finally:
+            self.unlock()
+
+    def open_map(self):
+        self.close()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def map_file(self):
+        # called with the lock held
+        size = os.fstat(self.fd).st_size
+        if size < header_size:
+            self.init_file(self.fd, self.min_capacity)
+        else:
+            header = os.pread(self.fd, header_size, 0)
+            if (struct.unpack(header_format, header)[0] != magic):
+                print("reinitializing " + self.path, file=sys.stderr)
+                self.replace_file(self.min_capacity)
+
+        self.mm = mmap.mmap(self.fd, 0)
+        self.capacity = self.get_header()[1]
+        self.mask = self.capacity - 1
+        self.slots = memoryview(self.mm)[header_size:].cast('Q')
+
+    @staticmethod
+    def init_file(fd, capacity):
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, header_size + 8 * capacity)
+        os.pwrite(fd, struct.pack(header_format, magic, capacity, 0, 0), 0)
+
+    def replace_file(self, capacity):
+        # swaps in a new, empty file rather than truncating the old one
+        # under the other processes' maps - they see the inode change in
+        # lock() and remap; called with the lock held
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.init_file(fd, capacity)
+        os.replace(tmp_path, self.path)
+
+        old_fd = self.fd
+        self.close_map()
+        self.fd = fd
+        os.close(old_fd)
+
+    def get_header(self):
+        return struct.unpack_from(header_format, self.mm, 0)
+
+    def set_header(self, count, max_id):
+        struct.pack_into(header_format, self.mm, 0, magic, self.capacity, count, max_id)
+
+    def lock(self):
+        while True:
+            if self.fd is None:
+                self.open_map()
+
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                st = None
+
+            if st and (st.st_ino == os.fstat(self.fd).st_ino):
+                break
+
+            # replaced (by grow) or removed (by purge) meanwhile
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.close()
+
+        if self.mm is None:
+            self.map_file()
+
+    def unlock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def contains(self, url):
+        if self.slots is None:
+            return False
+
+        h = hash_url(url)
+        i = h & self.mask
+        while True:
+            v = self.slots[i]
+            if not v:
+                return False
+            elif v == h:
+                return True
+
+            i = (i + 1) & self.mask
+
+    def add_hash(self, h):
+        # returns True if the hash wasn't there
+        i = h & self.mask
+        while True:
+            v = self.slots[i]
+            if not v:
+                self.slots[i] = h
+                return True
+            elif v == h:
+                return False
+
+            i = (i + 1) & self.mask
+
+    def add_hashes(self, hashes, max_id=None):
+        # called with the lock held
+        header = self.get_header()
+        count = header[2]
+        old_max_id = header[3]
+        if count + len(hashes) > max_load * self.capacity:
+            self.grow(count + len(hashes))
+            count = self.get_header()[2]
+
+        for h in hashes:
+            if self.add_hash(h):
+                count += 1
+
+        self.set_header(count, old_max_id if max_id is None else max_id)
+
+    def add_many(self, urls):
+        if not urls:
+            return
+
+        self.lock()
+        try:
+            self.add_hashes([ hash_url(url) for url in urls ])
+        finally:
+            self.unlock()
+
+    def grow(self, needed):
+        capacity = self.capacity
+        while needed > max_load * capacity:
+            capacity *= 2
+
+        print("growing %s to %d slots..." % (self.path, capacity), file=sys.stderr)
+        header = self.get_header()
+        hashes = [ v for v in self.slots if v ]
+        self.replace_file(capacity)
+        self.map_file()
+        self.add_hashes(hashes, header[3])
+
+    def sync(self):
+        # catches up with rows added since the last sync; called with
+        # the lock held
+        max_id = self.get_header()[3]
+        self.cur.execute("""select coalesce(max(id), 0)
+from %s""" % self.table)
+        top = self.cur.fetchone()[0]
+        if top < max_id:
+            print(self.table + " shrunk, rebuilding " + self.path, file=sys.stderr)
+            self.replace_file(self.min_capacity)
+            self.map_file()
+            max_id = 0
+
+        while max_id < top:
+            self.cur.execute("""select id, url
+from %s
+where id>%%s
+order by id
+limit %%s""" % self.table, (max_id, sync_batch))
+            rows = self.cur.fetchall()
+            if not rows:
+                break
+
+            max_id = rows[-1][0]
+            self.add_hashes([ hash_url(row[1]) for row in rows ], max_id)
+
+    def close_map(self):
+        if self.slots is not None:
+            self.slots.release()
+            self.slots = None
+
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def close(self):
+        self.close_map()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def make_known_filter(cur, table):
+    if get_option('known_filter', "1") != "1":
+        return None
+
+    return KnownFilter(cur, table, int(get_option('known_filter_capacity', "1048576")))
+
+def drop_known_filter(table):
+    # after deleting rows - the filter is rebuilt on next use
+    path = get_filter_path(table)
+    if os.path.exists(path):
+        os.remove(path)
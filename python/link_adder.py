@@ -0,0 +1,151 @@
+import re
+import sys
+from urllib.parse import urlunparse
+from common import get_option
+from host_check import HostCheck
+from known_filter import make_known_filter
+from mem_cache import MemCache
+from param_util import get_param_set
+from preference import BreathPreference, NoveltyPreference
+from url_normalizer import UrlNormalizer
+
+class LinkAdder(HostCheck):
+    def __init__(self, cur):
+        HostCheck.__init__(self, cur)
+
+        self.normalizer = UrlNormalizer(int(get_option('url_cache_size', "10000")))
+        self.known = make_known_filter(cur, 'field')
+        if not self.known:
+            self.mem_cache = MemCache(int(get_option('parse_cache_high_mark', "2000")))
+
+        if get_option('download_preference', 'novelty') == 'novelty':
+            self.preference = NoveltyPreference(int(get_option('novelty_high_mark', "20000")))
+        else:
+            self.preference = BreathPreference()
+
+        self.max_url_len = int(get_option("max_url_len", "512"))
+
+        # ignore case flag would be better dynamic, but Python 3.5.2
+        # doesn't support that...
+        url_blacklist_rx = get_option("url_blacklist_rx", "[.](?:jpe?g|pdf|png)$")
+        self.url_blacklist_rx = re.compile(url_blacklist_rx, re.I) if url_blacklist_rx else None
+
+        url_whitelist_rx = get_option("url_whitelist_rx", None)
+        self.url_whitelist_rx = re.compile(url_whitelist_rx, re.I) if url_whitelist_rx else None
+
+        self.comp_param = True if get_option("comp_param", True) else False
+        if self.comp_param:
+            self.cur.execute("""select nameval
+from param_blacklist
+order by nameval""")
+            rows = self.cur.fetchall()
+            self.param_blacklist = set((row[0] for row in rows))
+        # else param_blacklist isn't used
+
+        self.pending = [] # of (clean_pr, clean_url, host_id)
+        self.pending_urls = set()
+        self.queued = 0
+
+    def add_link(self, url):
+        hostname, clean_pr, clean_url = self.normalizer.normalize(url)
+        if hostname: # may not exist even for valid links, e.g. mailto:
+            host_id = self.get_host_id(hostname)
+            if host_id and clean_url:
+                skip_msg = None
+                if self.url_whitelist_rx and not self.url_whitelist_rx.search(clean_url):
+                    skip_msg = "not whitelisted"
+                elif self.url_blacklist_rx and self.url_blacklist_rx.search(clean_url):
+                    skip_msg = "blacklisted"
+                elif len(clean_url) > self.max_url_len:
+                    skip_msg = "too long"
+
+                if skip_msg:
+                    print("skipping %s b/c %s" % (clean_url, skip_msg), file=sys.stderr)
+                elif not self.is_known(clean_url) and (clean_url not in self.pending_urls):
+                    self.pending.append((clean_pr, clean_url, host_id))
+                    self.pending_urls.add(clean_url)
+
+    def is_known(self, clean_url):
+        if self.known:
+            return self.known.contains(clean_url)
+        else:
+            return self.mem_cache.check(clean_url)
+
+    def flush_links(self):
+        # all new links of a page are inserted together
+        if not self.pending:
+            return
+
+        pending = self.pending
+        self.pending = []
+        self.pending_urls = set()
+
+        self.cur.execute("""insert into field(url)
+select unnest(%s::varchar[])
+on conflict do nothing
+returning id, url""", ([ p[1] for p in pending ],))
+        rows = self.cur.fetchall()
+        if self.known:
+            # inserted or not, they're in field now
+            self.known.add_many([ p[1] for p in pending ])
+
+        if not rows:
+            return
+
+        url2id = dict((url, url_id) for url_id, url in rows)
+        inserted = [ (clean_pr, clean_url, host_id, url2id[clean_url]) for clean_pr, clean_url, host_id in pending if clean_url in url2id ]
+        if self.comp_param:
+            inserted = self.simplify_links(inserted)
+
+        if inserted:
+            self.cur.execute("""insert into download_queue(url_id, priority, host_id)
+select *
+from unnest(%s::integer[], %s::integer[], %s::integer[])
+on conflict do nothing""", ([ i[3] for i in inserted ], [ self.preference.prioritize(i[1]) for i in inserted ], [ i[2] for i in inserted ]))
+            self.queued += len(inserted)
+
+    def simplify_links(self, inserted):
+        simplified = [] # of (link, simple URL)
+        for link in inserted:
+            clean_pr = link[0]
+            if clean_pr[4]:
+                clean_params = get_param_set(clean_pr[4])
+                simple_params = clean_params.difference(self.param_blacklist)
+                simple_query = "&".join(sorted(simple_params))
+                if simple_query != clean_pr[4]:
+                    simple_pr = (clean_pr[0], clean_pr[1], clean_pr[2], clean_pr[3], simple_query, '')
+                    simplified.append((link, urlunparse(simple_pr)))
+
+        if not simplified:
+            return inserted
+
+        # do not set checkd if simplification exists - it might be a real URL
+        self.cur.execute("""insert into field(url, checkd)
+select unnest(%s::varchar[]), localtimestamp
+on conflict do nothing
+returning url""", ([ simple_url for link, simple_url in simplified ],))
+        created = set(row[0] for row in self.cur.fetchall())
+        if self.known:
+            self.known.add_many(created)
+
+        skipped = set() # of URL IDs
+        for link, simple_url in simplified:
+            if simple_url in created:
+                # the first link with the new simplification keeps it
+                created.remove(simple_url)
+            else:
+                print("skipping %s - simplification already exists" % (link[1],), file=sys.stderr)
+                skipped.add(link[3])
+
+        if not skipped:
+            return inserted
+
+        self.cur.execute("""update field
+set checkd=localtimestamp
+where id = any(%s)""", (sorted(skipped),))
+        return [ link for link in inserted if link[3] not in skipped ]
+
+    def close_links(self):
+        if self.known:
+            self.known.close()
+            self.known = None
@@ -65,8 +65,8 @@ where id=%s""", (i,))
         return self.cur.fetchone()
 
     def has_body(self, url_id):
-        volume_id = self.get_volume_id(url_id)
-        f = self.open_page(url_id, volume_id)
+        volume_id, body_hash = self.get_body_location(url_id)
+        f = self.open_page(url_id, volume_id, body_hash)
         if f is None:
             return False
         else:
@@ -0,0 +1,45 @@
+from collections import deque
+
+class OutcomeRing:
+    def __init__(self, size):
+        self.ring = deque(maxlen=size) # of bool, True => failed
+        self.failed = 0
+
+    def add(self, failed):
+        if len(self.ring) == self.ring.maxlen:
+            if self.ring[0]:
+                self.failed -= 1
+
+        self.ring.append(failed)
+        if failed:
+            self.failed += 1
+
+    def get_counts(self):
+        return (len(self.ring), self.failed)
+
+class OutcomeWindow:
+    # outcomes of the last downloads, overall and per host
+    def __init__(self, size):
+        self.size = size
+        self.overall = OutcomeRing(size)
+        self.hosts = {} # host_id -> OutcomeRing
+
+    def add(self, host_id, failed):
+        self.overall.add(failed)
+        ring = self.hosts.get(host_id)
+        if ring is None:
+            ring = OutcomeRing(self.size)
+            self.hosts[host_id] = ring
+
+        ring.add(failed)
+
+    def get_failed(self):
+        return self.overall.failed
+
+    def get_stats(self):
+        # (count, failed) tuples, None key for all hosts together
+        stats = { None: self.overall.get_counts() }
+        for host_id, ring in self.hosts.items():
+            stats[host_id] = ring.get_counts()
+
+        return stats
@@ -1,32 +1,147 @@
 from lxml import etree
 from urllib.parse import urljoin
+from common import get_option
+
+use_target = get_option('page_parser', 'iterparse') == 'target'
+chunk_size = 65536
+
+class LinkTarget:
+    # lxml parser target, passing <a> & <base> to PageParser
+    # without building a tree
+    def __init__(self, page_parser):
+        self.page_parser = page_parser
+        self.stack = [] # of open tags
+        self.hrefs = [] # of href of open <a>, in the same order as the parser sees them
+
+    def start(self, tag, attrib):
+        if tag == 'a':
+            self.hrefs.append(attrib.get('href'))
+        elif tag == 'base':
+            self.page_parser.handle_base(attrib.get('href'), self.stack[-1] if self.stack else None, self.stack[-2] if len(self.stack) > 1 else None)
+
+        self.stack.append(tag)
+
+    def end(self, tag):
+        if self.stack:
+            self.stack.pop()
+
+        if (tag == 'a') and self.hrefs:
+            href = self.hrefs.pop()
+            if href:
+                self.page_parser.add_href(href)
+
+    def close(self):
+        pass
 
 class PageParser:
     def __init__(self, owner, url):
         self.owner = owner
         self.base = url
         self.found_base = False
-                
+        self.pull_parser = None
+        self.target_parser = None
+
     def parse_links(self, fp):
+        if use_target:
+            self.parse_links_target(fp)
+            return
+
         # limit memory usage
         context = etree.iterparse(fp, events=('end',), tag=('a', 'base'), html=True, recover=True)
         for action, elem in context:
-            if not self.found_base and (elem.tag == 'base'):
-                parent = elem.getparent()[0]
-                if parent is not None and (parent.tag == 'head'):
-                    grandparent = parent.getparent()[0]
-                    if grandparent is not None and (grandparent.tag == 'html'):
-                        self.found_base = True
-                        href = elem.get('href')
-                        if href:
-                            self.base = urljoin(self.base, href)
-            elif elem.tag == 'a':
-                href = elem.get('href')
-                if href:
-                    link = urljoin(self.base, href)
-                    self.owner.add_link(link)
-                
-            # cleanup
-            elem.clear()
-            while elem.getprevious() is not None:
-                del elem.getparent()[0]
+            self.handle_elem(elem)
+
+    def parse_links_target(self, fp):
+        parser = etree.HTMLParser(target=LinkTarget(self), recover=True)
+        data = fp.read(chunk_size)
+        while data:
+            parser.feed(data)
+            data = fp.read(chunk_size)
+
+        parser.close()
+
+    def feed(self, data):
+        # incremental alternative to parse_links
+        if use_target:
+            if self.target_parser is None:
+                self.target_parser = etree.HTMLParser(target=LinkTarget(self), recover=True)
+
+            self.target_parser.feed(data)
+            return
+
+        if self.pull_parser is None:
+            self.pull_parser = etree.HTMLPullParser(events=('end',), tag=('a', 'base'), recover=True)
+
+        self.pull_parser.feed(data)
+        self.read_events()
+
+    def close(self):
+        if self.target_parser is not None:
+            try:
+                self.target_parser.close()
+            except etree.LxmlError:
+                pass
+
+            self.target_parser = None
+
+        if self.pull_parser is not None:
+            try:
+                self.pull_parser.close()
+            except etree.LxmlError:
+                pass
+
+            self.read_events()
+            self.pull_parser = None
+
+    def read_events(self):
+        for action, elem in self.pull_parser.read_events():
+            self.handle_elem(elem)
+
+    def handle_elem(self, elem):
+        if elem.tag == 'base':
+            parent = elem.getparent()
+            grandparent = parent.getparent() if parent is not None else None
+            self.handle_base(elem.get('href'), parent.tag if parent is not None else None, grandparent.tag if grandparent is not None else None)
+        elif elem.tag == 'a':
+            href = elem.get('href')
+            if href:
+                self.add_href(href)
+
+        # cleanup
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    def handle_base(self, href, parent_tag, grandparent_tag):
+        # only the first <base>, and only in <html><head>
+        if not self.found_base and (parent_tag == 'head') and (grandparent_tag == 'html'):
+            self.found_base = True
+            if href:
+                self.add_base(href)
+
+    def add_base(self, href):
+        self.base = urljoin(self.base, href)
+
+    def add_href(self, href):
+        link = urljoin(self.base, href)
+        self.owner.add_link(link)
+
+    def replay(self, events):
+        for is_base, href in events:
+            if is_base:
+                self.add_base(href)
+            else:
+                self.add_href(href)
+
+class HrefRecorder(PageParser):
+    # keeps hrefs unresolved, for replaying them later (with a base
+    # that may not be known yet)
+    def __init__(self):
+        PageParser.__init__(self, None, None)
+        self.events = [] # of (is_base, href)
+
+    def add_base(self, href):
+        self.events.append((True, href))
+
+    def add_href(self, href):
+        self.events.append((False, href))
@@ -1,33 +1,51 @@
 #!/usr/bin/python3
 
-import re
+import multiprocessing
 import select
 import sys
-from urllib.parse import urlparse, urlunparse
 from act_util import act_inc, act_dec
-from common import get_loose_path, get_netloc, get_option, make_connection, normalize_url_component
-from host_check import get_instance_id, get_parse_notification_name, HostCheck
-from mem_cache import MemCache
-from page_parser import PageParser
-from param_util import get_param_set
-from preference import BreathPreference, NoveltyPreference
+from body_cache import make_body_cache
+from common import get_option, make_connection
+from host_check import get_instance_id, get_parse_notification_name
+from link_adder import LinkAdder
+from page_parser import HrefRecorder, PageParser
+from queue_depth import has_download_work
 from volume_holder import VolumeHolder
 
-class PolyParser(VolumeHolder, HostCheck):
-    def __init__(self, single_action, conn, cur):
+worker_holder = None
+worker_body_cache = None
+
+def init_worker():
+    global worker_holder, worker_body_cache
+    worker_holder = VolumeHolder()
+    worker_body_cache = make_body_cache()
+
+def extract_links(task):
+    # runs in a worker process; links are resolved by the parent
+    url_id, volume_id, body_hash, content_hash = task
+    events = None
+    reader = worker_holder.open_page(url_id, volume_id, body_hash)
+    if reader:
+        try:
+            if worker_body_cache:
+                events = worker_body_cache.get_events(reader, content_hash or body_hash)
+            else:
+                recorder = HrefRecorder()
+                recorder.parse_links(reader)
+                events = recorder.events
+        finally:
+            reader.close()
+
+    return (url_id, events)
+
+class PolyParser(VolumeHolder, LinkAdder):
+    def __init__(self, single_action, conn, cur, workers=0):
         VolumeHolder.__init__(self)
-        HostCheck.__init__(self, cur)
+        LinkAdder.__init__(self, cur)
 
         inst_name = get_option("instance", None)
         self.instance_id = get_instance_id(cur, inst_name) # self.inst_id already used by HostCheck
 
-        self.mem_cache = MemCache(int(get_option('parse_cache_high_mark', "2000")), int(get_option('parse_cache_low_mark', "1000")))
-
-        if get_option('download_preference', 'novelty') == 'novelty':
-            self.preference = NoveltyPreference(int(get_option('novelty_high_mark', "20000")), int(get_option('novelty_low_mark', "15000")))
-        else:
-            self.preference = BreathPreference()
-
         self.single_action = single_action
         self.conn = conn
         self.notification_threshold = int(get_option('parse_notification_threshold', "1000"))
@@ -36,48 +54,85 @@ class PolyParser(VolumeHolder, HostCheck):
         self.page_limit = int(page_limit) if page_limit else None
         self.page_count = 0
 
-        self.max_url_len = int(get_option("max_url_len", "512"))
-
-        # ignore case flag would be better dynamic, but Python 3.5.2
-        # doesn't support that...
-        url_blacklist_rx = get_option("url_blacklist_rx", "[.](?:jpe?g|pdf|png)$")
-        self.url_blacklist_rx = re.compile(url_blacklist_rx, re.I) if url_blacklist_rx else None
+        self.parse_order = get_option('parse_order', 'url')
+        self.claim_volume = None # being claimed with parse_order=volume
+        self.claim_loose = False
+        # claiming by volume is too expensive for single items
+        self.parse_batch = int(get_option('parse_batch', "100" if (workers > 0) or (self.parse_order == 'volume') else "1"))
+
+        self.body_cache = None
+        self.workers = workers
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers, init_worker)
+        else:
+            self.body_cache = make_body_cache()
 
-        url_whitelist_rx = get_option("url_whitelist_rx", None)
-        self.url_whitelist_rx = re.compile(url_whitelist_rx, re.I) if url_whitelist_rx else None
+    def parse_all(self):
+        if self.pool:
+            self.parse_all_parallel()
+            return
+
+        rows = self.pop_work_items(self.parse_batch)
+        while rows:
+            for url_id, url, volume_id, body_hash, content_hash, unchanged in rows:
+                if not url:
+                    print("URL %d not found" % (url_id,), file=sys.stderr)
+                elif unchanged:
+                    self.skip(url_id, url)
+                else:
+                    self.parse(url_id, url, volume_id, body_hash, content_hash)
+
+            rows = self.pop_work_items(self.parse_batch)
 
-        self.comp_param = True if get_option("comp_param", True) else False
-        if self.comp_param:
-            self.cur.execute("""select nameval
-from param_blacklist
-order by nameval""")
-            rows = self.cur.fetchall()
-            self.param_blacklist = set((row[0] for row in rows))
-        # else param_blacklist isn't used
+        self.preference.mark_batch()
 
-    def parse_all(self):
-        row = self.pop_work_item()
-        while row:
-            url_id = row[0]
+    def parse_all_parallel(self):
+        rows = self.pop_work_items(self.parse_batch)
+        while rows:
+            urls = {}
+            tasks = []
+            content_hashes = {} # url_id -> body hash, for page_hash
+            for url_id, url, volume_id, body_hash, content_hash, unchanged in rows:
+                if not url:
+                    print("URL %d not found" % (url_id,), file=sys.stderr)
+                elif unchanged:
+                    print("skipping unchanged " + url + "...", file=sys.stderr)
+                else:
+                    urls[url_id] = url
+                    tasks.append((url_id, volume_id, body_hash, content_hash))
+                    if content_hash:
+                        content_hashes[url_id] = content_hash
+
+            # keep volumes together in a worker
+            chunksize = max(1, len(tasks) // (4 * self.workers))
+            for url_id, events in self.pool.imap(extract_links, tasks, chunksize):
+                url = urls[url_id]
+                print("parsing " + url + "...", file=sys.stderr)
+                if events is not None:
+                    parser = PageParser(self, url)
+                    parser.replay(events)
+                    self.flush_links()
+
+            self.cur.execute("""update field
+set parsed=localtimestamp
+where id = any(%s)""", ([ row[0] for row in rows ],))
 
-            url = self.get_url(url_id)
-            if not url:
-                print("URL %d not found" % (url_id,), file=sys.stderr)
-            else:
-                volume_id = self.get_volume_id(url_id)
-                self.parse(url_id, url, volume_id)
+            if content_hashes:
+                hash_ids = sorted(content_hashes.keys())
+                self.cur.execute("""update page_hash
+set parsed_hash=h.body_hash
+from unnest(%s::integer[], %s::char(40)[]) as h(url_id, body_hash)
+where page_hash.url_id=h.url_id""", (hash_ids, [ content_hashes[url_id] for url_id in hash_ids ]))
 
-            row = self.pop_work_item()
+            rows = self.pop_work_items(self.parse_batch)
 
         self.preference.mark_batch()
 
     def cond_notify(self):
         live = False
         if not self.single_action:
-            self.cur.execute("""select count(*)
-from download_queue""")
-            row = self.cur.fetchone()
-            live = row[0] > 0
+            live = has_download_work(self.cur)
             if live:
                 self.do_notify()
 
@@ -95,16 +150,34 @@ from download_queue""")
         while self.conn.notifies:
             self.conn.notifies.pop()
 
-    def parse(self, url_id, url, volume_id):
+    def parse(self, url_id, url, volume_id, body_hash, content_hash=None):
         print("parsing " + url + "...", file=sys.stderr)
-        reader = self.open_page(url_id, volume_id)
+        reader = self.open_page(url_id, volume_id, body_hash)
         if reader:
             try:
                 parser = PageParser(self, url)
-                parser.parse_links(reader)
+                if self.body_cache:
+                    # recently seen bodies aren't parsed again
+                    parser.replay(self.body_cache.get_events(reader, content_hash or body_hash))
+                else:
+                    parser.parse_links(reader)
             finally:
                 reader.close()
 
+            self.flush_links()
+
+        self.cur.execute("""update field
+set parsed=localtimestamp
+where id=%s""", (url_id,))
+
+        if content_hash:
+            self.cur.execute("""update page_hash
+set parsed_hash=%s
+where url_id=%s""", (content_hash, url_id))
+
+    def skip(self, url_id, url):
+        # links of the same body were stored before
+        print("skipping unchanged " + url + "...", file=sys.stderr)
         self.cur.execute("""update field
 set parsed=localtimestamp
 where id=%s""", (url_id,))
@@ -112,98 +185,140 @@ where id=%s""", (url_id,))
     def is_done(self):
         return self.page_limit and (self.page_count >= self.page_limit)
 
-    def pop_work_item(self):
-        if self.is_done():
-            return None
+    def pop_work_items(self, limit):
+        if self.page_limit:
+            limit = min(limit, self.page_limit - self.page_count)
 
-        sql_cond = ""
-        if self.instance_id:
-            sql_cond = """join locality on parse_queue.url_id=locality.url_id
-where instance_id=%d""" % self.instance_id
+        if limit <= 0:
+            return []
 
-        # https://blog.2ndquadrant.com/what-is-select-skip-locked-for-in-postgresql-9-5/
-        self.cur.execute("""delete from parse_queue
-where url_id = (
-        select parse_queue.url_id
-        from parse_queue
-        %s
-        order by parse_queue.url_id
-        for update skip locked
-        limit 1
-)
-returning url_id""" % sql_cond)
-        row = self.cur.fetchone()
-        if row:
-            self.page_count += 1
-            if not (self.page_count % self.notification_threshold):
+        if self.parse_order == 'volume':
+            rows = self.pop_volume_items(limit)
+        else:
+            rows = self.claim_items("parse_queue", [], "order by parse_queue.url_id", limit)
+
+        if rows:
+            prev_count = self.page_count
+            self.page_count += len(rows)
+            if (self.page_count // self.notification_threshold) > (prev_count // self.notification_threshold):
                 self.cond_notify()
 
-        return row
-
-    def add_link(self, url):
-        pr = urlparse(url.strip())
-        if pr.hostname: # may not exist even for valid links, e.g. mailto:
-            host_id = self.get_host_id(pr.hostname)
-            if host_id:
-                clean_pr = (pr.scheme, get_netloc(pr), normalize_url_component(pr.path), pr.params, normalize_url_component(pr.query), '')
-                clean_url = urlunparse(clean_pr)
-
-                skip_msg = None
-                if self.url_whitelist_rx and not self.url_whitelist_rx.search(clean_url):
-                    skip_msg = "not whitelisted"
-                elif self.url_blacklist_rx and self.url_blacklist_rx.search(clean_url):
-                    skip_msg = "blacklisted"
-                elif len(clean_url) > self.max_url_len:
-                    skip_msg = "too long"
-
-                if skip_msg:
-                    print("skipping %s b/c %s" % (clean_url, skip_msg), file=sys.stderr)
-                elif not self.mem_cache.check(clean_url):
-                    url_id = self.insert_link(clean_pr, clean_url)
-                    if url_id is not None:
-                        self.cur.execute("""insert into download_queue(url_id, priority, host_id)
-values(%s, %s, %s)
-on conflict do nothing""", (url_id, self.preference.prioritize(clean_url), host_id))
-
-    def insert_link(self, clean_pr, clean_url):
-        self.cur.execute("""insert into field(url)
-values(%s)
-on conflict do nothing
-returning id""", (clean_url,))
+        return rows
+
+    def pop_volume_items(self, limit):
+        # whole volumes (through idx_content_volume), loose pages last;
+        # the queue is searched for a volume only after the previous
+        # one ran dry
+        while True:
+            if (self.claim_volume is None) and not self.claim_loose:
+                self.claim_volume = self.find_volume()
+                self.claim_loose = self.claim_volume is None
+
+            if self.claim_loose:
+                rows = self.claim_items("""parse_queue
+                left join (
+                        content
+                        join directory on volume_id=directory.id and written is not null
+                ) on parse_queue.url_id=content.url_id""", [ "content.url_id is null" ], "order by parse_queue.url_id", limit)
+                # when done, volumes are checked again
+                self.claim_loose = len(rows) > 0
+                return rows
+
+            rows = self.claim_items("""content
+                join parse_queue on content.url_id=parse_queue.url_id""", [ "content.volume_id=%d" % self.claim_volume ], "", limit)
+            if rows:
+                return rows
+
+            self.claim_volume = None
+
+    def find_volume(self):
+        sql_from, sql_where = self.add_instance_cond("""parse_queue
+join content on parse_queue.url_id=content.url_id
+join directory on volume_id=directory.id and written is not null""", [])
+        self.cur.execute("""select volume_id
+from %s
+%s
+limit 1
+for update of parse_queue skip locked""" % (sql_from, sql_where))
         row = self.cur.fetchone()
-        if row is None:
-            return None
-
-        url_id = row[0]
-        if self.comp_param and clean_pr[4]:
-            clean_params = get_param_set(clean_pr[4])
-            simple_params = clean_params.difference(self.param_blacklist)
-            simple_query = "&".join(sorted(simple_params))
-            if simple_query != clean_pr[4]:
-                simple_pr = (clean_pr[0], clean_pr[1], clean_pr[2], clean_pr[3], simple_query, '')
-                simple_url = urlunparse(simple_pr)
-                # do not set checkd if simplification exists - it might be a real URL
-                self.cur.execute("""insert into field(url, checkd)
-values(%s, localtimestamp)
-on conflict do nothing
-returning id""", (simple_url,))
-                if self.cur.fetchone() is None:
-                    print("skipping %s - simplification already exists" % (clean_url,), file=sys.stderr)
-                    self.cur.execute("""update field
-set checkd=localtimestamp
-where id=%s""", (url_id,))
-                    url_id = None
+        return row[0] if row else None
+
+    def add_instance_cond(self, sql_from, conds):
+        if self.instance_id:
+            sql_from += "\njoin locality on parse_queue.url_id=locality.url_id"
+            conds = conds + [ "instance_id=%d" % self.instance_id ]
 
-        return url_id
+        sql_where = ("where " + " and ".join(conds)) if conds else ""
+        return (sql_from, sql_where)
+
+    def claim_items(self, sql_from, conds, sql_order, limit):
+        sql_from, sql_where = self.add_instance_cond(sql_from, conds)
+
+        if self.body_dedup:
+            # shared bodies are never in the page's volume
+            sql_location = "case when body_ref.hash is null then content.volume_id else body_blob.volume_id end, body_ref.hash"
+            sql_blob = """left join body_ref on claimed.url_id=body_ref.url_id
+left join body_blob on body_ref.hash=body_blob.hash"""
+        else:
+            sql_location = "content.volume_id, null"
+            sql_blob = ""
+
+        if self.skip_unchanged:
+            sql_hash = "page_hash.body_hash, coalesce(page_hash.body_hash=page_hash.parsed_hash, false)"
+            sql_blob += """
+left join page_hash on claimed.url_id=page_hash.url_id"""
+        else:
+            sql_hash = "null, false"
+
+        # https://blog.2ndquadrant.com/what-is-select-skip-locked-for-in-postgresql-9-5/
+        self.cur.execute("""with claimed as (
+        delete from parse_queue
+        where url_id in (
+                select parse_queue.url_id
+                from %s
+                %s
+                %s
+                limit %d
+                for update of parse_queue skip locked
+        )
+        returning url_id
+)
+select claimed.url_id, url, %s, %s
+from claimed
+left join field on claimed.url_id=field.id
+left join (
+        content
+        join directory on volume_id=directory.id and written is not null
+) on claimed.url_id=content.url_id
+%s
+order by claimed.url_id""" % (sql_from, sql_where, sql_order, limit, sql_location, sql_hash, sql_blob))
+        return self.cur.fetchall()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        self.close_links()
+        VolumeHolder.close(self)
 
 
 def main():
-    single_action = (len(sys.argv) == 2) and (sys.argv[1] == '--single-action')
+    args = sys.argv[1:]
+    single_action = '--single-action' in args
+    workers = 0
+    if '--workers' in args:
+        i = args.index('--workers') + 1
+        if (i >= len(args)) or not args[i].isdigit():
+            raise Exception("usage: %s [--single-action] [--workers count]" % sys.argv[0])
+
+        workers = int(args[i])
 
     conn = make_connection()
     try:
         with conn.cursor() as cur:
-            parser = PolyParser(single_action, conn, cur)
+            parser = PolyParser(single_action, conn, cur, workers)
             try:
                 while not parser.is_done():
                     act_inc(cur)
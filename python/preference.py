@@ -1,4 +1,5 @@
 import re
+import sys
 
 class BreathPreference:
     def __init__(self):
@@ -10,15 +11,21 @@ class BreathPreference:
     def mark_batch(self):
         self.round += 1
         
+class TrieNode:
+    __slots__ = ('count', 'children')
+
+    def __init__(self):
+        self.count = 0
+        self.children = None # segment -> TrieNode
+
 class NoveltyPreference:
-    def __init__(self, high_mark, low_mark):
-        assert high_mark > low_mark
-        assert low_mark > 0
-        self.high_mark = high_mark
-        self.low_mark = low_mark
+    # counts URL prefixes (as segment sequences) in a trie
+    def __init__(self, capacity):
+        self.capacity = capacity
         self.segment_rx = re.compile("[:/.?&=,;]")
-        self.occurence = {}
-        
+        self.root = TrieNode()
+        self.size = 0 # number of nodes under root
+
     def prioritize(self, url):
         raw_segments = self.segment_rx.split(url)
         raw_segments.pop(0) # ignore protocol
@@ -26,29 +33,77 @@ class NoveltyPreference:
         l = len(segments)
         i = 1
         prio = 1 # 0 is for seeds
+        node = self.root
         while i < l:
-            head = tuple(segments[0:i])
-            cnt = self.occurence.get(head, 0)
-            prio += (i * cnt)
-            self.occurence[head] = cnt + 1
+            if node.children is None:
+                node.children = {}
+
+            seg = sys.intern(segments[i - 1])
+            child = node.children.get(seg)
+            if child is None:
+                child = TrieNode()
+                node.children[seg] = child
+                self.size += 1
+
+            prio += (i * child.count)
+            child.count += 1
+            node = child
             i += 1
 
-        if len(self.occurence) > self.high_mark:
+        if self.size > self.capacity:
             self.prune()
 
         if url.find('?') >= 0:
             prio *= 100
-            
+
         return prio
-        
+
     def mark_batch(self):
         pass
-    
+
     def prune(self):
-        occurence = {}
-        # FIXME: should use heap
-        lst = sorted([ (v, k) for k, v in self.occurence.items() ], reverse=True)
-        for v, k in lst[:self.low_mark]:
-            occurence[k] = v
+        # A prefix is counted at least as often as any of its
+        # extensions, so dropping nodes below a count threshold drops
+        # whole subtrees.
+        hist = {} # count -> number of nodes
+        stack = [ self.root ]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                for child in node.children.values():
+                    hist[child.count] = hist.get(child.count, 0) + 1
+                    stack.append(child)
+
+        # keeps the nodes above the boundary count and as many nodes
+        # with the boundary count as fit (their ancestors come first)
+        target = self.capacity * 3 // 4
+        boundary = 0
+        kept = 0
+        for cnt in sorted(hist.keys(), reverse=True):
+            if kept + hist[cnt] > target:
+                boundary = cnt
+                break
+
+            kept += hist[cnt]
+
+        quota = target - kept
+        self.size = 0
+        stack = [ self.root ]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                doomed = []
+                for seg, child in node.children.items():
+                    if child.count < boundary:
+                        doomed.append(seg)
+                    elif child.count == boundary:
+                        if quota > 0:
+                            quota -= 1
+                        else:
+                            doomed.append(seg)
+
+                for seg in doomed:
+                    del node.children[seg]
 
-        self.occurence = occurence
+                self.size += len(node.children)
+                stack.extend(node.children.values())
@@ -2,15 +2,18 @@
 
 import os
 import sys
-import zipfile
-from common import get_loose_path, get_volume_path, make_connection
+from common import get_blob_name, get_blob_path, get_loose_path, get_volume_path, make_connection
 from cursor_wrapper import CursorWrapper
+from known_filter import drop_known_filter
+from volume_format import create_volume, get_volume_format, open_volume
 
 class Purger(CursorWrapper):
     def __init__(self, cur):
         CursorWrapper.__init__(self, cur)
         self.shrunk = set() # volume IDs
         self.doomed = set() # URL IDs
+        self.doomed_blobs = set() # member names
+        self.doomed_any = False
 
     def purge_fast(self, url_id):
         volume_id = self.get_volume_id(url_id)
@@ -51,8 +54,44 @@ where url_id=%s""", (url_id,))
         self.cur.execute("""delete from download_queue
 where url_id=%s""", (url_id,))
 
+        if self.skip_unchanged:
+            self.cur.execute("""delete from page_hash
+where url_id=%s""", (url_id,))
+
+        if self.body_dedup:
+            self.purge_ref(url_id)
+
         self.cur.execute("""delete from field
 where id=%s""", (url_id,))
+        self.doomed_any = True
+
+    def purge_ref(self, url_id):
+        self.cur.execute("""delete from body_ref
+where url_id=%s
+returning hash""", (url_id,))
+        row = self.cur.fetchone()
+        if not row:
+            return
+
+        # the body goes when its last page does
+        body_hash = row[0]
+        self.cur.execute("""select url_id
+from body_ref
+where hash=%s
+limit 1""", (body_hash,))
+        if self.cur.fetchone():
+            return
+
+        self.cur.execute("""delete from body_blob
+where hash=%s
+returning volume_id""", (body_hash,))
+        row = self.cur.fetchone()
+        volume_id = row[0] if row else None
+        if volume_id is None:
+            self.ensure_removed(get_blob_path(body_hash))
+        else:
+            self.shrunk.add(volume_id)
+            self.doomed_blobs.add(get_blob_name(body_hash))
 
     def purge_from_set(self, url_id):
         self.cur.execute("""delete from edge_sets
@@ -102,7 +141,13 @@ where to_set=%s""", (children,))
         for volume_id in self.shrunk:
             self.shrink_volume(volume_id)
 
+        if self.doomed_any:
+            drop_known_filter('field')
+
     def is_doomed(self, filename):
+        if filename.startswith('b'):
+            return filename in self.doomed_blobs
+
         stem = filename[:-1] if filename.endswith('h') else filename
         url_id = int(stem)
         return url_id in self.doomed
@@ -112,8 +157,9 @@ where to_set=%s""", (children,))
         backup_path = archive_path + '.bak'
         os.rename(archive_path, backup_path)
 
-        zin = zipfile.ZipFile(backup_path)
-        zout = zipfile.ZipFile(archive_path, mode='w', compression=zipfile.ZIP_DEFLATED)
+        zin = open_volume(backup_path)
+        zback = open(archive_path, mode='wb')
+        zout = create_volume(zback, get_volume_format(zin))
         remains = False
         for item in zin.infolist():
             if not self.is_doomed(item.filename):
@@ -122,6 +168,7 @@ where to_set=%s""", (children,))
                  remains = True
 
         zout.close()
+        zback.close()
         zin.close()
 
         os.remove(backup_path)
@@ -0,0 +1,38 @@
+# Queue probes that stop at the first rows they need, instead of
+# counting whole queues (which may have millions of rows).
+
+def count_download_work(cur, hosts, limit):
+    cur.execute("""select count(*)
+from (
+        select 1
+        from download_queue
+        where host_id = any(%s)
+        limit %s
+) sq""", (hosts, limit))
+    row = cur.fetchone()
+    return row[0]
+
+def has_download_work(cur):
+    cur.execute("""select exists (
+        select 1
+        from download_queue
+)""")
+    row = cur.fetchone()
+    return row[0]
+
+def has_parse_work(cur, inst_id):
+    if not inst_id:
+        cur.execute("""select exists (
+        select 1
+        from parse_queue
+)""")
+    else:
+        cur.execute("""select exists (
+        select 1
+        from parse_queue
+        join locality on parse_queue.url_id=locality.url_id
+        where instance_id=%s
+)""", (inst_id,))
+
+    row = cur.fetchone()
+    return row[0]
@@ -0,0 +1,18 @@
+from common import get_option, make_connection
+
+def stream_rows(query, params=None):
+    # Iterates over the rows of a (big) query without loading them all,
+    # using a server-side cursor. That needs a transaction, so it runs
+    # on its own connection, leaving the caller's autocommit one free
+    # for writes; the rows come from a snapshot taken at the start.
+    fetch_size = int(get_option('stream_fetch_size', "10000"))
+    conn = make_connection()
+    try:
+        conn.autocommit = False
+        with conn.cursor(name='row_stream') as cur:
+            cur.itersize = fetch_size
+            cur.execute(query, params)
+            for row in cur:
+                yield row
+    finally:
+        conn.close()
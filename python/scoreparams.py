@@ -4,6 +4,7 @@ from urllib.parse import urlparse, urlunparse
 from common import get_netloc, make_connection
 from cursor_wrapper import CursorWrapper
 from param_util import get_param_set
+from row_stream import stream_rows
 
 class Builder(CursorWrapper):
     def __init__(self, cur):
@@ -12,11 +13,9 @@ class Builder(CursorWrapper):
 
     def prepare(self):
         print("checking equivalence classes...")
-        self.cur.execute("""select from_set, to_set
+        for row in stream_rows("""select from_set, to_set
 from edge_sets
-where array_length(from_set, 1) > 1""")
-        rows = self.cur.fetchall()
-        for row in rows:
+where array_length(from_set, 1) > 1"""):
             self.prepare_class(*row)
 
     def process(self):
@@ -6,6 +6,7 @@ from urllib.parse import urlparse
 from act_util import act_reset
 from common import get_option, make_connection
 from host_check import get_instance_id, make_canonicalizer
+from row_stream import stream_rows
 
 class Seeder:
     def __init__(self, cur):
@@ -67,11 +68,9 @@ returning url_id""", (url_id, 0, hostname))
             self.do_add_instance()
 
     def seed_queue(self):
-        self.cur.execute("""select url, id from field
+        for row in stream_rows("""select url, id from field
 where checkd is null
-order by id""")
-        rows = self.cur.fetchall()
-        for row in rows:
+order by id"""):
             self.add_work(*row)
 
     def do_add_instance(self):
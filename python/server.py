@@ -10,6 +10,7 @@ import sys
 from common import get_mandatory_option, get_option, schema
 from storage_bridge import StorageBridge
 from volume_bridge import VolumeBridge
+from volume_pool import get_volume_pool
 
 the_pool = pool.ThreadedConnectionPool(database='ampelopsis', host=get_option('dbhost', 'localhost'), user=get_mandatory_option('dbuser'), password=get_mandatory_option('dbpass'), minconn=0, maxconn=int(get_option('own_max_num_conn', "4")))
 
@@ -109,7 +110,8 @@ instance=%s
             sz = bridge.get_headers_size(url_id, volume_id)
             ct = "text/plain"
         else:
-            sz = bridge.get_body_size_ex(url_id, volume_id)
+            body_volume_id, body_hash = bridge.get_body_location(url_id)
+            sz = bridge.get_body_size_ex(url_id, body_volume_id, body_hash)
             ct = bridge.get_content_type(url_id, volume_id)
 
         compress_threshold = int(get_option("compress_threshold", "100"))
@@ -124,7 +126,7 @@ instance=%s
             if headers_flag:
                 reader = bridge.open_headers(url_id, volume_id)
             else:
-                reader = bridge.open_page_ex(url_id, volume_id)
+                reader = bridge.open_page_ex(url_id, body_volume_id, body_hash)
 
         if reader is None:
             # headers are optional (e.g. drive.py doesn't store
@@ -217,8 +219,26 @@ instance=%s
 
         return intermediary.getvalue()
 
+def preload_volumes(count):
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""select id
+from directory
+where written is not null
+order by id desc
+limit %s""", (count,))
+            rows = cur.fetchall()
+            get_volume_pool().preload([ row[0] for row in rows ])
+    finally:
+        the_pool.putconn(conn)
+
 def main():
     try:
+        preload_count = int(get_option('server_preload_volumes', "0"))
+        if preload_count > 0:
+            preload_volumes(preload_count)
+
         raw_port = get_option('server_port', "8888")
         server = ThreadingHTTPServer(('', int(raw_port)), StorageHandler)
         server.serve_forever()
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 from common import get_mandatory_option, make_connection
+from row_stream import stream_rows
 
 class Squisher:
     def __init__(self, cur):
@@ -27,12 +28,10 @@ def main():
     try:
         with conn.cursor() as cur:
             squisher = Squisher(cur)
-            cur.execute("""select url_id
-from nodes
-order by url_id""")
-            rows = cur.fetchall()
             idx = 0
-            for row in rows:
+            for row in stream_rows("""select url_id
+from nodes
+order by url_id"""):
                 squisher.add(row[0])
                 idx += 1
                 if not (idx % 10000):
@@ -66,14 +66,8 @@ where id=%s and checkd is not null and failed is null and instance_id is not nul
                 statinfo = os.stat(loose_path)
                 sz = statinfo.st_size
         else:
-            if volume_id != self.volume_id:
-                self.change_volume(volume_id)
-
-            try:
-                info = self.zp.getinfo(str(url_id) + 'h')
-                sz = info.file_size
-            except KeyError:
-                pass
+            self.volume_id = volume_id
+            sz = self.volume_pool.get_member_size(volume_id, str(url_id) + 'h')
 
         return sz
 
@@ -94,9 +88,9 @@ where id=%s and checkd is not null and failed is null and instance_id is not nul
 
         return "text/plain"
 
-    def get_body_size_ex(self, url_id, volume_id):
+    def get_body_size_ex(self, url_id, volume_id, body_hash=None):
         if not self.alt_repre:
-            return self.get_body_size(url_id, volume_id)
+            return self.get_body_size(url_id, volume_id, body_hash)
 
         sz = None
         loose_path = get_loose_path(url_id, alt_repre=self.alt_repre)
@@ -106,9 +100,9 @@ where id=%s and checkd is not null and failed is null and instance_id is not nul
 
         return sz
 
-    def open_page_ex(self, url_id, volume_id):
+    def open_page_ex(self, url_id, volume_id, body_hash=None):
         if not self.alt_repre:
-            return self.open_page(url_id, volume_id)
+            return self.open_page(url_id, volume_id, body_hash)
 
         f = None
         loose_path = get_loose_path(url_id, alt_repre=self.alt_repre)
@@ -2,11 +2,13 @@
 
 import re
 import sys
-from urllib.parse import urlparse, urlunparse
-from common import get_netloc, get_option, make_connection, normalize_url_component
+from common import get_option, make_connection
+from row_stream import stream_rows
 from host_check import HostCheck
+from known_filter import make_known_filter
 from mem_cache import MemCache
 from page_parser import PageParser
+from url_normalizer import UrlNormalizer
 from volume_holder import VolumeHolder
 
 class Tracer(VolumeHolder, HostCheck):
@@ -14,15 +16,20 @@ class Tracer(VolumeHolder, HostCheck):
         VolumeHolder.__init__(self)
         HostCheck.__init__(self, cur)
 
-        self.mem_cache = MemCache(int(get_option('parse_cache_high_mark', "2000")), int(get_option('parse_cache_low_mark', "1000")))
+        self.known = make_known_filter(cur, 'neighbors')
+        if not self.known:
+            self.mem_cache = MemCache(int(get_option('parse_cache_high_mark', "2000")))
+
+        self.found = set() # of neighbor URLs on the current page
+        self.normalizer = UrlNormalizer(int(get_option('url_cache_size', "10000")))
 
         top_protocols = get_option('top_protocols', 'http https')
         self.protocols = set(re.split('\\s+', top_protocols))
 
     def parse(self, url, url_id):
         print("parsing " + url + "...", file=sys.stderr)
-        volume_id = self.get_volume_id(url_id)
-        reader = self.open_page(url_id, volume_id)
+        volume_id, body_hash = self.get_body_location(url_id)
+        reader = self.open_page(url_id, volume_id, body_hash)
         if reader:
             try:
                 parser = PageParser(self, url)
@@ -30,18 +37,40 @@ class Tracer(VolumeHolder, HostCheck):
             finally:
                 reader.close()
 
+            self.insert_neighbors()
+
     def add_link(self, url):
-        pr = urlparse(url.strip())
-        if not pr.scheme in self.protocols:
+        hostname, clean_pr, clean_url = self.normalizer.normalize(url)
+        if (not clean_pr) or (not clean_pr[0] in self.protocols):
             return
 
-        host_id = self.get_host_id(pr.hostname)
+        host_id = self.get_host_id(hostname)
         if not host_id:
-            clean_pr = (pr.scheme, get_netloc(pr), normalize_url_component(pr.path), pr.params, normalize_url_component(pr.query), '')
-            clean_url = urlunparse(clean_pr)
-            if not self.mem_cache.check(clean_url):
-                self.cur.execute("""insert into neighbors(url) values(%s)
-on conflict do nothing""", (clean_url,))
+            if self.known:
+                if not self.known.contains(clean_url):
+                    self.found.add(clean_url)
+            elif not self.mem_cache.check(clean_url):
+                self.found.add(clean_url)
+
+    def insert_neighbors(self):
+        if not self.found:
+            return
+
+        found = sorted(self.found)
+        self.found = set()
+        self.cur.execute("""insert into neighbors(url)
+select unnest(%s::varchar[])
+on conflict do nothing""", (found,))
+        if self.known:
+            self.known.add_many(found)
+
+    def close(self):
+        if self.known:
+            self.known.close()
+            self.known = None
+
+        VolumeHolder.close(self)
+
 
 def main():
     conn = make_connection()
@@ -49,12 +78,10 @@ def main():
         with conn.cursor() as cur:
             tracer = Tracer(cur)
             try:
-                cur.execute("""select url, id
+                for row in stream_rows("""select url, id
 from field
 where checkd is not null
-order by url""")
-                rows = cur.fetchall()
-                for row in rows:
+order by url"""):
                     tracer.parse(*row)
             finally:
                 tracer.close()
@@ -3,9 +3,9 @@
 import os
 import shutil
 import sys
-import zipfile
-from common import get_loose_path, get_option, get_volume_path, make_connection
+from common import get_blob_path, get_loose_path, get_option, get_volume_path, make_connection
 from host_check import get_instance_id
+from volume_format import open_volume
 
 
 class VolumeDecompressor:
@@ -13,7 +13,7 @@ class VolumeDecompressor:
         self.cur = cur # no CursorWrapper methods needed here
         self.inst_id = inst_id
         self.volume_id = volume_id
-        self.zp = zipfile.ZipFile(volume_path)
+        self.zp = open_volume(volume_path)
 
     def decompress(self):
         self.cur.execute("""select url_id
@@ -24,6 +24,8 @@ order by url_id""", (self.volume_id,))
         for row in rows:
             self.decompress_url(row[0])
 
+        self.decompress_blobs()
+
         # assuming the database has not changed since query above - no
         # other script may modify it while this one runs
         self.cur.execute("""delete from content
@@ -53,6 +55,27 @@ values(%s, %s)
 on conflict(url_id) do update
 set instance_id=%s""", (url_id, self.inst_id, self.inst_id))
 
+    def decompress_blobs(self):
+        # shared bodies (see body_dedup) become loose blobs
+        names = [ nm for nm in self.zp.namelist() if nm.startswith('b') ]
+        if not names:
+            return
+
+        for nm in names:
+            reader = self.zp.open(self.zp.getinfo(nm))
+            try:
+                writer = open(get_blob_path(nm[1:]), "wb")
+                try:
+                    shutil.copyfileobj(reader, writer)
+                finally:
+                    writer.close()
+            finally:
+                reader.close()
+
+        self.cur.execute("""update body_blob
+set volume_id=null
+where volume_id=%s""", (self.volume_id,))
+
     def get_reader(self, url_id, hdr):
         nm = str(url_id)
         if hdr:
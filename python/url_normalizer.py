@@ -0,0 +1,51 @@
+import re
+from urllib.parse import urlparse, urlunparse
+from common import get_netloc, normalize_url_component
+from freq_cache import FreqCache
+
+# URLs which the general path below wouldn't change: lowercase
+# http(s) scheme, plain host without port or credentials, path &
+# query without characters that would be quoted or split (no
+# params, no fragment, no '%' which might be a space); '-' must stay
+# last in the character classes
+safe_chars = "A-Za-z0-9_.~/+$*()\\[\\]{},:!|\"&=-"
+clean_rx = re.compile("^(https?)://([A-Za-z0-9.-]+)(/[" + safe_chars + "]*)?(?:\\?([?" + safe_chars + "]+))?$")
+
+class UrlNormalizer:
+    def __init__(self, cache_size):
+        self.cache = FreqCache(cache_size) if cache_size > 0 else None
+
+    def normalize(self, url):
+        # returns (hostname, clean_pr, clean_url); hostname may be
+        # None (e.g. for mailto:), clean_pr & clean_url are None for
+        # unparsable URLs
+        url = url.strip()
+        if self.cache is None:
+            return self.normalize_uncached(url)
+
+        norm = self.cache.get(url)
+        if norm is None:
+            norm = self.normalize_uncached(url)
+            self.cache.put(url, norm)
+
+        return norm
+
+    @staticmethod
+    def normalize_uncached(url):
+        m = clean_rx.match(url)
+        if m:
+            netloc = m.group(2)
+            clean_pr = (m.group(1), netloc, m.group(3) or '', '', m.group(4) or '', '')
+            return (netloc.lower(), clean_pr, url)
+
+        try:
+            pr = urlparse(url)
+        except ValueError: # e.g. invalid IPv6 address
+            return (None, None, None)
+
+        try:
+            clean_pr = (pr.scheme, get_netloc(pr), normalize_url_component(pr.path), pr.params, normalize_url_component(pr.query), '')
+        except ValueError: # e.g. invalid port
+            return (pr.hostname, None, None)
+
+        return (pr.hostname, clean_pr, urlunparse(clean_pr))
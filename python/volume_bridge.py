@@ -2,6 +2,7 @@ import os
 from cursor_wrapper import CursorWrapper
 from host_check import get_instance_id
 from common import get_option, get_volume_path
+from volume_pool import get_volume_pool
 
 class VolumeBridge(CursorWrapper):
     def __init__(self, cur):
@@ -58,6 +59,7 @@ where id=%s and written is not null""", (volume_id,))
         return open(volume_path, "rb")
 
     def delete_volume(self, volume_id):
+        get_volume_pool().discard(volume_id)
         volume_path = get_volume_path(volume_id)
         if os.path.exists(volume_path):
             os.remove(volume_path)
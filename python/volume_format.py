@@ -0,0 +1,30 @@
+import zipfile
+from common import get_option
+
+zstd_magic = b'AMPZSTD1'
+
+# Volumes keep the .zip suffix whatever their format; readers check
+# the magic. zstandard is only needed for zstd volumes.
+
+def open_volume(path):
+    with open(path, 'rb') as f:
+        head = f.read(len(zstd_magic))
+
+    if head == zstd_magic:
+        from zstd_volume import ZstdVolume
+        return ZstdVolume(path)
+
+    return zipfile.ZipFile(path)
+
+def get_volume_format(volume):
+    return 'zip' if isinstance(volume, zipfile.ZipFile) else 'zstd'
+
+def create_volume(fileobj, volume_format=None):
+    if volume_format is None:
+        volume_format = get_option('volume_format', 'zip')
+
+    if volume_format == 'zstd':
+        from zstd_volume import ZstdVolumeWriter
+        return ZstdVolumeWriter(fileobj, int(get_option('zstd_level', "10")), int(get_option('zstd_dict_size', str(110 * 1024))), int(get_option('zstd_sample_size', str(8 * 1024 * 1024))))
+
+    return zipfile.ZipFile(fileobj, mode='w', compression=zipfile.ZIP_DEFLATED)
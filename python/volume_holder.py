@@ -1,27 +1,24 @@
 import os
-import zipfile
-from common import get_loose_path, get_volume_path
+from common import get_blob_name, get_blob_path, get_loose_path
+from volume_pool import get_volume_pool
 
 class VolumeHolder:
     def __init__(self):
-        self.volume_id = None
-        self.zp = None
+        self.volume_id = None # last volume used
+        self.volume_pool = get_volume_pool()
+
+    def open_page(self, url_id, volume_id=None, body_hash=None):
+        if body_hash is not None:
+            return self.open_blob(body_hash, volume_id)
 
-    def open_page(self, url_id, volume_id=None):
         f = None
         if volume_id is None:
             loose_path = get_loose_path(url_id)
             if os.path.exists(loose_path):
                 f = open(loose_path, "rb")
         else:
-            if volume_id != self.volume_id:
-                self.change_volume(volume_id)
-
-            try:
-                info = self.zp.getinfo(str(url_id))
-                f = self.zp.open(info)
-            except KeyError:
-                pass
+            self.volume_id = volume_id
+            f = self.volume_pool.open_member(volume_id, str(url_id))
 
         return f
 
@@ -32,14 +29,8 @@ class VolumeHolder:
             if os.path.exists(loose_path):
                 f = open(loose_path, "rb")
         else:
-            if volume_id != self.volume_id:
-                self.change_volume(volume_id)
-
-            try:
-                info = self.zp.getinfo(str(url_id) + 'h')
-                f = self.zp.open(info)
-            except KeyError:
-                pass
+            self.volume_id = volume_id
+            f = self.volume_pool.open_member(volume_id, str(url_id) + 'h')
 
         return f
 
@@ -51,7 +42,10 @@ class VolumeHolder:
 
         return f
 
-    def get_body_size(self, url_id, volume_id=None):
+    def get_body_size(self, url_id, volume_id=None, body_hash=None):
+        if body_hash is not None:
+            return self.get_blob_size(body_hash, volume_id)
+
         sz = None
         if volume_id is None:
             loose_path = get_loose_path(url_id)
@@ -59,26 +53,36 @@ class VolumeHolder:
                 statinfo = os.stat(loose_path)
                 sz = statinfo.st_size
         else:
-            if volume_id != self.volume_id:
-                self.change_volume(volume_id)
-
-            try:
-                info = self.zp.getinfo(str(url_id))
-                sz = info.file_size
-            except KeyError:
-                pass
+            self.volume_id = volume_id
+            sz = self.volume_pool.get_member_size(volume_id, str(url_id))
 
         return sz
 
-    def change_volume(self, volume_id):
-        if self.zp is not None:
-            self.zp.close()
+    def open_blob(self, body_hash, volume_id=None):
+        f = None
+        if volume_id is None:
+            blob_path = get_blob_path(body_hash)
+            if os.path.exists(blob_path):
+                f = open(blob_path, "rb")
+        else:
+            self.volume_id = volume_id
+            f = self.volume_pool.open_member(volume_id, get_blob_name(body_hash))
+
+        return f
 
-        archive_path = get_volume_path(volume_id)
-        self.zp = zipfile.ZipFile(archive_path)
-        self.volume_id = volume_id
+    def get_blob_size(self, body_hash, volume_id=None):
+        sz = None
+        if volume_id is None:
+            blob_path = get_blob_path(body_hash)
+            if os.path.exists(blob_path):
+                statinfo = os.stat(blob_path)
+                sz = statinfo.st_size
+        else:
+            self.volume_id = volume_id
+            sz = self.volume_pool.get_member_size(volume_id, get_blob_name(body_hash))
+
+        return sz
 
     def close(self):
-        if self.zp is not None:
-            self.zp.close()
-            self.zp = None
+        # volumes stay open in the pool
+        self.volume_id = None
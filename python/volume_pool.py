@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+from common import get_option, get_volume_path
+from volume_format import open_volume
+
+class VolumePool:
+    # Open volumes (with their parsed central directories/indices), least
+    # recently used closed first. Members are looked up & opened with
+    # the lock held, so that a concurrently evicted ZipFile is never
+    # used; reading an opened member is safe even after its ZipFile
+    # has been closed. Volumes rewritten (e.g. by purge.py) since they
+    # were opened are reopened.
+    def __init__(self, size):
+        assert size > 0
+        self.size = size
+        self.lock = threading.Lock()
+        self.volumes = OrderedDict() # volume_id -> (ZipFile, stat key)
+        self.pid = os.getpid()
+
+    def get_volume(self, volume_id):
+        # called with the lock held
+        if self.pid != os.getpid():
+            # forked - the file offsets would be shared with the parent
+            self.volumes = OrderedDict()
+            self.pid = os.getpid()
+
+        path = get_volume_path(volume_id)
+        entry = self.volumes.get(volume_id)
+        if entry is not None:
+            try:
+                statinfo = os.stat(path)
+                stat_key = (statinfo.st_ino, statinfo.st_mtime_ns)
+            except FileNotFoundError:
+                stat_key = None
+
+            if entry[1] == stat_key:
+                self.volumes.move_to_end(volume_id)
+                return entry[0]
+
+            del self.volumes[volume_id]
+            entry[0].close()
+
+        # stat first - a file replaced in between is reopened next time
+        statinfo = os.stat(path)
+        zp = open_volume(path)
+        self.volumes[volume_id] = (zp, (statinfo.st_ino, statinfo.st_mtime_ns))
+        while len(self.volumes) > self.size:
+            old_id, old_entry = self.volumes.popitem(last=False)
+            old_entry[0].close()
+
+        return zp
+
+    def open_member(self, volume_id, name):
+        with self.lock:
+            zp = self.get_volume(volume_id)
+            try:
+                info = zp.getinfo(name)
+                return zp.open(info)
+            except KeyError:
+                return None
+
+    def get_member_size(self, volume_id, name):
+        with self.lock:
+            zp = self.get_volume(volume_id)
+            try:
+                info = zp.getinfo(name)
+                return info.file_size
+            except KeyError:
+                return None
+
+    def preload(self, volume_ids):
+        with self.lock:
+            for volume_id in volume_ids[:self.size]:
+                try:
+                    self.get_volume(volume_id)
+                except FileNotFoundError: # e.g. on another instance
+                    pass
+
+    def discard(self, volume_id):
+        # for volumes which changed or were deleted
+        with self.lock:
+            entry = self.volumes.pop(volume_id, None)
+            if (entry is not None) and (self.pid == os.getpid()):
+                entry[0].close()
+
+the_volume_pool = None
+pool_lock = threading.Lock()
+
+def get_volume_pool():
+    global the_volume_pool
+    with pool_lock:
+        if the_volume_pool is None:
+            the_volume_pool = VolumePool(int(get_option('volume_pool_size', "8")))
+
+        return the_volume_pool
@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+from common import get_blob_lock_key, get_blob_path
+
+class WriteBehind:
+    def __init__(self, cur, inst_id, size_threshold, time_threshold, body_dedup=False):
+        self.cur = cur
+        self.inst_id = inst_id
+        self.body_dedup = body_dedup
+        self.size_threshold = size_threshold
+        self.time_threshold = time_threshold
+        self.reset()
+
+    def reset(self):
+        self.errors = [] # of (url_id, error_code, error_message)
+        self.localities = {} # url_id -> update flag
+        self.checked = [] # of URL IDs
+        self.unpacked = [] # of URL IDs
+        self.parsable = [] # of URL IDs
+        self.parsed = [] # of URL IDs
+        self.stored = set() # URL IDs with a new shared body (see Retriever.store_blob)
+        self.replaced = [] # of URL IDs with a new (or no) body
+        self.hashes = {} # url_id -> (body hash, parsed flag)
+        self.started = None
+
+    def add_error(self, url_id, error_code, error_message):
+        self.touch()
+        self.errors.append((url_id, error_code, error_message))
+
+    def add_checked(self, url_id, upd_inst):
+        self.touch()
+        if self.inst_id:
+            self.localities[url_id] = self.localities.get(url_id, False) or upd_inst
+
+        self.checked.append(url_id)
+        self.replaced.append(url_id)
+
+    def add_fresh(self, url_id):
+        self.touch()
+        self.checked.append(url_id)
+
+    def add_unpacked(self, url_id):
+        self.touch()
+        self.unpacked.append(url_id)
+
+    def add_stored(self, url_id):
+        self.touch()
+        self.stored.add(url_id)
+
+    def add_hash(self, url_id, body_hash, parsed):
+        self.touch()
+        self.hashes[url_id] = (body_hash, parsed)
+
+    def add_parsable(self, url_id):
+        self.touch()
+        self.parsable.append(url_id)
+
+    def add_parsed(self, url_id):
+        self.touch()
+        self.parsed.append(url_id)
+
+    def touch(self):
+        if self.started is None:
+            self.started = time.time()
+
+    def cond_flush(self):
+        if self.started is None:
+            return
+
+        if (len(self.checked) >= self.size_threshold) or ((time.time() - self.started) >= self.time_threshold):
+            self.flush()
+
+    def flush(self):
+        if self.started is None:
+            return
+
+        # same order as the single-row statements it replaces -
+        # parse_queue last, so that the parser sees complete records;
+        # every part is dropped as soon as it's written, so that a
+        # flush retried after an error doesn't repeat it
+        if self.errors:
+            self.cur.execute("""insert into download_error(url_id, error_code, error_message, failed)
+select url_id, error_code, error_message, localtimestamp
+from unnest(%s::integer[], %s::integer[], %s::varchar[]) as e(url_id, error_code, error_message)""", ([ e[0] for e in self.errors ], [ e[1] for e in self.errors ], [ e[2] for e in self.errors ]))
+            self.errors = []
+
+        if self.localities:
+            self.flush_localities()
+
+        if self.checked:
+            self.cur.execute("""update field
+set checkd=localtimestamp
+where id = any(%s)""", (self.checked,))
+            self.checked = []
+
+        if self.unpacked:
+            self.cur.execute("""delete from content
+where url_id = any(%s)""", (self.unpacked,))
+            self.unpacked = []
+
+        if self.body_dedup:
+            self.flush_refs()
+
+        if self.hashes:
+            self.flush_hashes()
+
+        if self.parsed:
+            self.cur.execute("""update field
+set parsed=localtimestamp
+where id = any(%s)""", (self.parsed,))
+            self.parsed = []
+
+        if self.parsable:
+            self.cur.execute("""insert into parse_queue(url_id)
+select unnest(%s::integer[])
+on conflict(url_id) do nothing""", (self.parsable,))
+
+        self.reset()
+
+    def flush_refs(self):
+        # previously shared bodies of pages re-downloaded without one
+        self.replaced = sorted(set(url_id for url_id in self.replaced if url_id not in self.stored))
+        self.stored = set()
+
+        if self.replaced:
+            self.cur.execute("""delete from body_ref
+where url_id = any(%s)
+returning hash""", (self.replaced,))
+            rows = self.cur.fetchall()
+            self.replaced = []
+            self.release_blobs(sorted(set(row[0] for row in rows)))
+
+    def release_blobs(self, hashes):
+        # drops blobs which lost their last page
+        for body_hash in hashes:
+            lock_key = get_blob_lock_key(body_hash)
+            self.cur.execute("""select pg_advisory_lock(%s)""", (lock_key,))
+            try:
+                self.cur.execute("""delete from body_blob
+where hash=%s and not exists (
+        select url_id
+        from body_ref
+        where hash=%s
+)
+returning volume_id""", (body_hash, body_hash))
+                row = self.cur.fetchone()
+                if row and (row[0] is None):
+                    try:
+                        os.remove(get_blob_path(body_hash))
+                    except FileNotFoundError:
+                        pass
+            finally:
+                self.cur.execute("""select pg_advisory_unlock(%s)""", (lock_key,))
+
+    def flush_hashes(self):
+        # the hash of the previously parsed body is kept, so that
+        # parse.py can skip the page if it didn't change
+        hash_ids = sorted(self.hashes.keys())
+        self.cur.execute("""insert into page_hash(url_id, body_hash, parsed_hash)
+select url_id, body_hash, case when parsed then body_hash end
+from unnest(%s::integer[], %s::char(40)[], %s::boolean[]) as h(url_id, body_hash, parsed)
+on conflict(url_id) do update
+set body_hash=excluded.body_hash, parsed_hash=coalesce(excluded.parsed_hash, page_hash.parsed_hash)""", (hash_ids, [ self.hashes[url_id][0] for url_id in hash_ids ], [ self.hashes[url_id][1] for url_id in hash_ids ]))
+        self.hashes = {}
+
+    def flush_localities(self):
+        # Mostly there should be no existing record.
+        updated = sorted(url_id for url_id, upd_inst in self.localities.items() if upd_inst)
+        if updated:
+            # When there is (e.g. after restarting download), the
+            # download locality should be updated.
+            self.cur.execute("""insert into locality(url_id, instance_id)
+select unnest(%s::integer[]), %s
+on conflict(url_id) do update
+set instance_id=excluded.instance_id""", (updated, self.inst_id))
+            for url_id in updated:
+                del self.localities[url_id]
+
+        kept = sorted(url_id for url_id, upd_inst in self.localities.items() if not upd_inst)
+        if kept:
+            # On the other hand, if somebody (e.g. sync.py) changed
+            # instance after download, hopefully they knew what they
+            # were doing...
+            self.cur.execute("""insert into locality(url_id, instance_id)
+select unnest(%s::integer[]), %s
+on conflict(url_id) do nothing
+returning url_id""", (kept, self.inst_id))
+            self.localities = {}
+            rows = self.cur.fetchall()
+            if len(rows) < len(kept):
+                self.cur.execute("""select url_id, instance_id
+from locality
+where url_id = any(%s) and instance_id<>%s
+order by url_id""", (kept, self.inst_id))
+                rows = self.cur.fetchall()
+                for url_id, instance_id in rows:
+                    print("cannot change instance of %d (from %d to %d)" % (url_id, instance_id, self.inst_id), file=sys.stderr)
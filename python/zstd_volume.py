@@ -0,0 +1,156 @@
+import io
+import os
+import struct
+import zstandard
+
+# Volume layout: magic, dictionary length & dictionary, zstd frames of
+# the members, index (name length, name, offset, compressed & raw
+# size for every member), index offset & length, magic again.
+magic = b'AMPZSTD1'
+dict_header_format = '<I'
+entry_format = '<QQQ'
+footer_format = '<QQ8s'
+
+class ZstdInfo:
+    # the subset of zipfile.ZipInfo used by readers
+    def __init__(self, filename, offset=0, compress_size=0, file_size=0):
+        self.filename = filename
+        self.offset = offset
+        self.compress_size = compress_size
+        self.file_size = file_size
+
+class ZstdVolume:
+    # read-only, with the zipfile.ZipFile methods volume readers use;
+    # safe to share between threads
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self.read_index()
+        except:
+            os.close(self.fd)
+            raise
+
+    def read_index(self):
+        sz = os.fstat(self.fd).st_size
+        footer_size = struct.calcsize(footer_format)
+        index_offset, index_len, tail = struct.unpack(footer_format, os.pread(self.fd, footer_size, sz - footer_size))
+        if tail != magic:
+            raise Exception("invalid zstd volume")
+
+        head_size = len(magic) + struct.calcsize(dict_header_format)
+        head = os.pread(self.fd, head_size, 0)
+        dict_len = struct.unpack(dict_header_format, head[len(magic):])[0]
+        self.dict_data = zstandard.ZstdCompressionDict(os.pread(self.fd, dict_len, head_size)) if dict_len else None
+
+        index = os.pread(self.fd, index_len, index_offset)
+        self.members = {} # name -> ZstdInfo
+        self.order = [] # of ZstdInfo
+        entry_size = struct.calcsize(entry_format)
+        pos = 0
+        while pos < len(index):
+            name_len = struct.unpack_from('<H', index, pos)[0]
+            pos += 2
+            name = index[pos:pos + name_len].decode('utf-8')
+            pos += name_len
+            offset, compress_size, file_size = struct.unpack_from(entry_format, index, pos)
+            pos += entry_size
+            info = ZstdInfo(name, offset, compress_size, file_size)
+            self.members[name] = info
+            self.order.append(info)
+
+    def getinfo(self, name):
+        return self.members[name] # KeyError like zipfile
+
+    def infolist(self):
+        return list(self.order)
+
+    def namelist(self):
+        return [ info.filename for info in self.order ]
+
+    def read(self, name):
+        info = self.members[name] if isinstance(name, str) else name
+        frame = os.pread(self.fd, info.compress_size, info.offset)
+        decompressor = zstandard.ZstdDecompressor(dict_data=self.dict_data) if self.dict_data else zstandard.ZstdDecompressor()
+        return decompressor.decompress(frame, max_output_size=info.file_size)
+
+    def open(self, name):
+        return io.BytesIO(self.read(name))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class ZstdVolumeWriter:
+    # The first members are kept in memory as samples for training the
+    # volume's dictionary, everything after that is written directly.
+    def __init__(self, fileobj, level, dict_size, sample_size):
+        self.fp = fileobj
+        self.level = level
+        self.dict_size = dict_size
+        self.sample_size = sample_size
+        self.samples = [] # of (name, data)
+        self.sampled = 0
+        self.compressor = None
+        self.index = [] # of ZstdInfo
+
+    def write(self, path, arcname):
+        with open(path, 'rb') as f:
+            self.writestr(arcname, f.read())
+
+    def writestr(self, name, data):
+        if not isinstance(name, str):
+            name = name.filename
+
+        if self.compressor is None:
+            self.samples.append((name, data))
+            self.sampled += len(data)
+            if self.sampled >= self.sample_size:
+                self.start()
+        else:
+            self.write_member(name, data)
+
+    def start(self):
+        dict_data = None
+        if self.dict_size and (len(self.samples) > 1):
+            try:
+                dict_data = zstandard.train_dictionary(self.dict_size, [ data for name, data in self.samples ])
+            except zstandard.ZstdError: # too few samples
+                pass
+
+        raw_dict = dict_data.as_bytes() if dict_data else b''
+        self.fp.write(magic)
+        self.fp.write(struct.pack(dict_header_format, len(raw_dict)))
+        self.fp.write(raw_dict)
+        if dict_data:
+            self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dict_data)
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=self.level)
+
+        for name, data in self.samples:
+            self.write_member(name, data)
+
+        self.samples = []
+
+    def write_member(self, name, data):
+        frame = self.compressor.compress(data)
+        offset = self.fp.tell()
+        self.fp.write(frame)
+        self.index.append(ZstdInfo(name, offset, len(frame), len(data)))
+
+    def close(self):
+        if self.compressor is None:
+            self.start()
+
+        index_offset = self.fp.tell()
+        index = io.BytesIO()
+        for info in self.index:
+            raw_name = info.filename.encode('utf-8')
+            index.write(struct.pack('<H', len(raw_name)))
+            index.write(raw_name)
+            index.write(struct.pack(entry_format, info.offset, info.compress_size, info.file_size))
+
+        raw_index = index.getvalue()
+        self.fp.write(raw_index)
+        self.fp.write(struct.pack(footer_format, index_offset, len(raw_index), magic))
+        self.fp.flush()
@@ -0,0 +1,9 @@
+create table body_blob(hash char(40) primary key,
+	volume_id integer references directory(id));
+
+create index idx_body_blob_volume on body_blob(volume_id);
+
+create table body_ref(url_id integer references field(id) primary key,
+	hash char(40) references body_blob(hash) not null);
+
+create index idx_body_ref_hash on body_ref(hash);
@@ -0,0 +1,3 @@
+create table page_hash(url_id integer references field(id) primary key,
+	body_hash char(40) not null,
+	parsed_hash char(40));